@@ -0,0 +1,21 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import os
+import sys
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root)
+
+# without a local `settings.py`, run against the defaults
+try:
+    import settings
+except ImportError:
+    loader = SourceFileLoader("settings", os.path.join(root, "settings.py_example"))
+    spec = importlib.util.spec_from_loader("settings", loader)
+    settings = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(settings)
+    sys.modules["settings"] = settings
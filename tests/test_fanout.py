@@ -0,0 +1,69 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import asyncio
+
+from wowlet_backend.fanout import ClientQueue, Update, serve
+
+
+async def stalled_send(frame: bytes):
+    # a client that stopped reading; the transport buffer is full
+    await asyncio.Event().wait()
+
+
+async def receive_forever():
+    await asyncio.Event().wait()
+
+
+def test_evict_disconnects_stalled_client():
+    async def main():
+        queue = ClientQueue(maxsize=4, max_lag=3600)
+        handler = asyncio.ensure_future(serve(queue, stalled_send, receive_forever()))
+        await asyncio.sleep(0)
+
+        # distinct cmds exceed the queue depth while `send` is stuck
+        for i in range(6):
+            queue.put(Update.create(f"cmd{i}", 1, {"i": i}))
+        await asyncio.wait_for(handler, 1)
+        assert queue.evicted
+
+    asyncio.run(main())
+
+
+def test_stalled_send_evicts_after_max_lag():
+    async def main():
+        queue = ClientQueue(maxsize=4, max_lag=0.05)
+        handler = asyncio.ensure_future(serve(queue, stalled_send, receive_forever()))
+        queue.put(Update.create("cmd", 1, {}))
+        await asyncio.wait_for(handler, 1)
+        assert queue.evicted
+
+    asyncio.run(main())
+
+
+def test_serve_sends_frames():
+    async def main():
+        sent = []
+
+        async def send(frame: bytes):
+            sent.append(frame)
+
+        queue = ClientQueue()
+        handler = asyncio.ensure_future(serve(queue, send, receive_forever()))
+        queue.put(Update.create("cmd", 1, {"a": 1}))
+        await asyncio.sleep(0.01)
+        handler.cancel()
+        assert sent == [b'{"cmd": "cmd", "seq": 1, "data": {"a": 1}}']
+        assert not queue.evicted
+
+    asyncio.run(main())
+
+
+def test_topics_map_to_broadcast_cmds():
+    from wowlet_backend.fanout import topics
+    from wowlet_backend.snapshot import websocket_cmd
+
+    available = topics()
+    assert available["rpc_nodes"] == available["nodes"] == websocket_cmd("rpc_nodes") == "nodes"
+    assert available["blockheights"] == "blockheights"
@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+from wowlet_backend.restoreheights import RestoreHeights
+
+
+def chain(block_times):
+    """(height, timestamp) of every block, for the given block times."""
+    timestamp = 1000000
+    blocks = [(0, timestamp)]
+    for height, block_time in enumerate(block_times, start=1):
+        timestamp += block_time
+        blocks.append((height, timestamp))
+    return blocks
+
+
+def test_height_at_never_rounds_up():
+    # slow blocks first, then a burst of fast ones: interpolating
+    # between the samples would land after the real height
+    blocks = chain([600] * 1000 + [10] * 2000)
+    index = RestoreHeights.from_lines(f"{h}:{t}" for h, t in blocks[::1500])
+
+    for height, timestamp in blocks:
+        restore_height = index.height_at(timestamp)
+        assert restore_height <= height
+
+
+def test_height_at_before_first_height():
+    index = RestoreHeights.from_lines(["1:1000", "1501:4000"])
+    assert index.height_at(999) is None
+    assert index.height_at(1000) == 1
+    assert index.height_at(3999) == 1
+    assert index.height_at(10 ** 10) == 1501
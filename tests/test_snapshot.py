@@ -0,0 +1,42 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import asyncio
+
+from wowlet_backend import snapshot
+from wowlet_backend.snapshot import Snapshot
+
+
+def test_version_restart(monkeypatch):
+    builds = []
+    version = [500]
+
+    async def build():
+        builds.append(version[0])
+        return Snapshot.from_raw(version[0], {key: None for key in snapshot.KEYS})
+
+    monkeypatch.setattr(snapshot, "_build", build)
+    snapshot.reset()
+
+    async def main():
+        snapshot.expire(500)
+        await snapshot.current()
+        await snapshot.current()
+        assert builds == [500]
+
+        # FLUSHDB; the rebuild after MAX_AGE finds the counter restarted
+        version[0] = 0
+        snapshot._snapshot.created -= snapshot.MAX_AGE
+        await snapshot.current()
+        await snapshot.current()
+        assert builds == [500, 0]
+
+        # the first invalidation after the restart
+        version[0] = 1
+        snapshot.expire(1)
+        await snapshot.current()
+        await snapshot.current()
+        assert builds == [500, 0, 1]
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+"""
+Measures websocket fan-out cost as a function of the number of
+connected clients; compares per-client serialization (legacy) with
+the shared-frame path in `wowlet_backend.fanout`.
+
+    python -m utils.bench_broadcast
+"""
+
+import sys
+import json
+import time
+import asyncio
+import statistics
+
+from wowlet_backend.fanout import ClientQueue, Update, deliver, register, unregister
+
+CLIENTS = [1, 10, 100, 1000, 5000]
+ROUNDS = 20
+
+
+def payload() -> list:
+    """Something shaped like an `rpc_nodes` result."""
+    with open('data/nodes.json', 'r') as f:
+        nodes = json.loads(f.read())
+    rtn = []
+    for coin, nettypes in nodes.items():
+        for nettype, types in nettypes.items():
+            for _type, addresses in types.items():
+                rtn += [{
+                    "address": f"http://{address}",
+                    "height": 1337000,
+                    "target_height": 1337000,
+                    "online": True,
+                    "nettype": nettype,
+                    "type": _type
+                } for address in addresses]
+    return rtn
+
+
+async def legacy(queues, data):
+    for queue in queues:
+        await queue.put({"cmd": "nodes", "data": data})
+    for queue in queues:
+        json.dumps(queue.get_nowait()).encode()
+
+
+async def shared(queues, data):
+    deliver(Update.create("nodes", 1, data))
+    for queue in queues:
+        await queue.get()
+
+
+async def measure(fn, queues, data) -> float:
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        await fn(queues, data)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+async def main():
+    data = payload()
+    print(f"payload: {len(json.dumps(data))} bytes, {ROUNDS} rounds, median per broadcast\n")
+    print(f"{'clients':>8} {'legacy (ms)':>12} {'shared (ms)':>12} {'speedup':>8}")
+
+    for n in CLIENTS:
+        clients = [ClientQueue() for _ in range(n)]
+        for client in clients:
+            register(client)
+
+        a = await measure(legacy, [asyncio.Queue() for _ in range(n)], data)
+        b = await measure(shared, clients, data)
+        print(f"{n:>8} {a * 1000:>12.3f} {b * 1000:>12.3f} {a / b:>7.1f}x")
+
+        for client in clients:
+            unregister(client)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+"""
+Throughput and tail latency of `WebsocketParse.requestPIN` and
+`WebsocketParse.lookupPIN`:
+
+- allocation at several fill levels of the PIN space (empty, 50%, 95%)
+- concurrent lookups
+- allocation during expiry churn (PINs expiring and being swept back)
+
+    python -m utils.bench_pins [--fake] [--redis redis://localhost] [--db 15]
+
+`--fake` runs against fakeredis instead of a local Redis; install
+`utils/requirements.txt` for it. WARNING: flushes the given Redis DB.
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from typing import List, Callable, Awaitable
+
+import aioredis
+
+import wowlet_backend.factory as factory
+import wowlet_backend.wsparse as wsparse
+from wowlet_backend.utils import redis_eval
+from wowlet_backend.wsparse import WebsocketParse
+from utils.stress_pins import random_address, request
+
+SAMPLES = 500
+CONCURRENCY = 50
+
+
+def report(name: str, timings: List[float], elapsed: float):
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000
+    print(f"{name:<28} {len(timings) / elapsed:>10.0f} {p50:>9.3f} {p99:>9.3f}")
+
+
+async def run(fn: Callable[[int], Awaitable], n: int, concurrency: int = CONCURRENCY):
+    """Call `fn(i)` for i in range(n), `concurrency` at a time;
+    returns (results, per-call timings, elapsed)."""
+    timings, results = [], [None] * n
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(i):
+        async with semaphore:
+            start = time.perf_counter()
+            results[i] = await fn(i)
+            timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed(i) for i in range(n)])
+    return results, timings, time.perf_counter() - start
+
+
+async def fill(occupancy: float) -> List[str]:
+    """Allocate PINs until the space is `occupancy` full."""
+    await factory.cache.flushdb()
+    amount = int(len(wsparse.PIN_SPACE) * occupancy)
+    pins, _, _ = await run(lambda i: request(random_address()), amount, concurrency=200)
+    return pins
+
+
+async def bench_allocation(occupancy: float):
+    await fill(occupancy)
+    free = len(wsparse.PIN_SPACE) - int(len(wsparse.PIN_SPACE) * occupancy)
+    n = min(SAMPLES, free // 2)
+    pins, timings, elapsed = await run(lambda i: request(random_address()), n)
+    assert all(pins), "allocation failed"
+    report(f"requestPIN @ {occupancy * 100:.0f}% full", timings, elapsed)
+
+
+async def bench_lookup():
+    pins = await fill(0.5)
+    n = SAMPLES * 10
+    results, timings, elapsed = await run(lambda i: WebsocketParse.lookupPIN({"PIN": pins[i % len(pins)]}), n)
+    assert all(r["address"] for r in results), "lookup failed"
+    report("lookupPIN @ 50% full", timings, elapsed)
+
+
+async def bench_churn():
+    """Fill to 95% with short-lived PINs, let them expire, then
+    allocate while the sweeper returns them to the pool."""
+    ttl = wsparse.PIN_TTL
+    wsparse.PIN_TTL = 1
+    try:
+        await fill(0.95)
+    finally:
+        wsparse.PIN_TTL = ttl
+    await asyncio.sleep(1.5)
+
+    sweeper = asyncio.ensure_future(redis_eval(wsparse.LUA_SWEEP_PINS, **wsparse.pin_script_args()))
+    pins, timings, elapsed = await run(lambda i: request(random_address()), SAMPLES)
+    reclaimed = await sweeper
+    assert all(pins), "allocation failed"
+    report(f"requestPIN, churn ({reclaimed} swept)", timings, elapsed)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis", default="redis://localhost")
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--fake", action="store_true")
+    args = parser.parse_args()
+
+    if args.fake:
+        import fakeredis.aioredis
+        factory.cache = await fakeredis.aioredis.create_redis_pool()
+    else:
+        factory.cache = await aioredis.create_redis_pool(args.redis, db=args.db)
+
+    print(f"{'':<28} {'ops/sec':>10} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for occupancy in [0, 0.5, 0.95]:
+        await bench_allocation(occupancy)
+    await bench_lookup()
+    await bench_churn()
+
+    await factory.cache.flushdb()
+    factory.cache.close()
+    await factory.cache.wait_closed()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,72 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+"""
+A fake `monerod` that mines a block every few seconds, to try out the
+push-based blockheight source of `BlockheightTask`. It serves `/get_height`
+and publishes `json-minimal-chain_main` on ZMQ (if pyzmq is installed).
+
+    python -m utils.fake_daemon [--height 2200000] [--interval 10]
+    WOWLET_BLOCKHEIGHT_RPC=http://127.0.0.1:18081 ...
+    WOWLET_BLOCKHEIGHT_ZMQ=tcp://127.0.0.1:18083 ...
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+
+from aiohttp import web
+
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
+
+class FakeDaemon:
+    def __init__(self, height: int):
+        self.height = height  # amount of blocks, as reported by `/get_height`
+        self.socket = None
+
+    async def get_height(self, request):
+        return web.json_response({"height": self.height, "status": "OK", "untrusted": False})
+
+    async def mine(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.height += 1
+            print(f"block {self.height - 1}")
+            if self.socket:
+                blob = {"first_height": self.height - 1, "first_prev_id": os.urandom(32).hex(),
+                        "ids": [os.urandom(32).hex()]}
+                await self.socket.send_string("json-minimal-chain_main:" + json.dumps(blob))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=2200000)
+    parser.add_argument("--interval", type=float, default=10)
+    parser.add_argument("--rpc-port", type=int, default=18081)
+    parser.add_argument("--zmq-pub", default="tcp://127.0.0.1:18083")
+    args = parser.parse_args()
+
+    daemon = FakeDaemon(args.height)
+    if zmq:
+        daemon.socket = zmq.asyncio.Context.instance().socket(zmq.PUB)
+        daemon.socket.bind(args.zmq_pub)
+
+    app = web.Application()
+    app.router.add_route("*", "/get_height", daemon.get_height)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.rpc_port).start()
+
+    await daemon.mine(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -2,17 +2,24 @@
 # Copyright (c) 2020, The Monero Project.
 # Copyright (c) 2020, dsc@xmr.pm
 
+# Writes one `height:timestamp` line per 1500 blocks, loaded by `wowlet_backend.restoreheights`
+#   python utils/generate_heights_db.py [explorer_url] [current_height] [coin_symbol] [coin_mode]
+
 import re, os, sys, requests
 
-current_height = 664767
-f = open("heights.txt", "a")
+explorer = sys.argv[1] if len(sys.argv) > 1 else "https://stagenet.xmrchain.net/"
+current_height = int(sys.argv[2]) if len(sys.argv) > 2 else 664767
+coin_symbol = sys.argv[3] if len(sys.argv) > 3 else "xmr"
+coin_mode = sys.argv[4] if len(sys.argv) > 4 else "stagenet"
+
+f = open(f"data/restore_heights_{coin_symbol}_{coin_mode}.txt", "a")
 for i in range(0, current_height, 1500):
     if i == 0:
         i = 1
     if i % (1500*8) == 0:
         print(f"[*] {current_height-i}")
 
-    url = f"https://stagenet.xmrchain.net/block/{i}"
+    url = f"{explorer.rstrip('/')}/block/{i}"
     resp = requests.get(url, headers={"User-Agent": "Feather"})
     resp.raise_for_status()
     content = resp.content.decode()
@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+"""
+Concurrency stress test for PIN allocation against a local Redis;
+fires concurrent `requestPIN` calls (distinct and duplicate addresses)
+and verifies there are no collisions or lost updates.
+
+    python -m utils.stress_pins [redis://localhost] [db]
+
+WARNING: flushes the given Redis DB (default: 15).
+"""
+
+import sys
+import time
+import random
+import string
+import asyncio
+
+import aioredis
+
+import wowlet_backend.factory as factory
+from wowlet_backend.wsparse import WebsocketParse, pin_key
+
+CONCURRENCY = 2000
+
+
+def random_address() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=97))
+
+
+async def request(address: str) -> str:
+    return await WebsocketParse.requestPIN({"address": address, "signature": "SigV1stress"})
+
+
+async def main(address: str = "redis://localhost", db: int = 15):
+    factory.cache = await aioredis.create_redis_pool(address, db=int(db))
+    await factory.cache.flushdb()
+
+    # 1. distinct addresses, all at once
+    addresses = [random_address() for _ in range(CONCURRENCY)]
+    start = time.perf_counter()
+    pins = await asyncio.gather(*[request(a) for a in addresses])
+    elapsed = time.perf_counter() - start
+
+    assert all(pins), "allocation failed"
+    assert len(set(pins)) == len(pins), f"collision: {len(pins) - len(set(pins))} duplicate PINs"
+    for address, pin in zip(addresses, pins):
+        owner = await factory.cache.get(pin_key(int(pin)))
+        assert owner.decode() == address, f"lost update for PIN {pin}"
+        result = await WebsocketParse.lookupPIN({"PIN": pin})
+        assert result["address"] == address
+
+    print(f"{CONCURRENCY} concurrent allocations in {elapsed:.3f}s "
+          f"({CONCURRENCY / elapsed:.0f} ops/sec), no collisions")
+
+    # 2. the same address, concurrently; must yield a single PIN
+    address = random_address()
+    pins = await asyncio.gather(*[request(address) for _ in range(100)])
+    assert len(set(pins)) == 1, f"one address got {len(set(pins))} PINs"
+    print("100 concurrent requests for one address yield one PIN")
+
+    await factory.cache.flushdb()
+    factory.cache.close()
+    await factory.cache.wait_closed()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(*sys.argv[1:])))
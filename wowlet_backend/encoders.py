@@ -0,0 +1,111 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import json
+from typing import Dict, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class RawJSON(bytes):
+    """Data that is already JSON encoded, e.g. straight from Redis; spliced
+    into JSON frames as-is, only decoded for other encodings."""
+
+
+def splice_frame(cmd: str, data: bytes) -> bytes:
+    """A `{"cmd", "data"}` JSON frame, for data that is already JSON encoded."""
+    return b'{"cmd": ' + json.dumps(cmd).encode() + b', "data": ' + data + b'}'
+
+
+class Encoder:
+    """
+    Websocket message encoding. Clients negotiate one via the
+    `wowlet.<name>` subprotocol or the `hello` command; JSON is
+    the default. Register additional encodings with `register()`.
+    """
+    name: str = None
+
+    @property
+    def subprotocol(self) -> str:
+        return f"wowlet.{self.name}"
+
+    def dumps(self, obj) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, buffer: bytes):
+        raise NotImplementedError()
+
+    def frame(self, cmd: str, data) -> bytes:
+        """Encode a `{"cmd", "data"}` frame."""
+        if isinstance(data, RawJSON):
+            data = json.loads(data)
+        return self.dumps({"cmd": cmd, "data": data})
+
+
+class JSONEncoder(Encoder):
+    name = "json"
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    def loads(self, buffer):
+        return json.loads(buffer)
+
+    def frame(self, cmd: str, data) -> bytes:
+        if isinstance(data, RawJSON):
+            return splice_frame(cmd, data)
+        return super(JSONEncoder, self).frame(cmd, data)
+
+
+class MsgpackEncoder(Encoder):
+    name = "msgpack"
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, buffer: bytes):
+        return msgpack.unpackb(buffer, raw=False, strict_map_key=False)
+
+
+class CBOREncoder(Encoder):
+    name = "cbor"
+
+    def dumps(self, obj) -> bytes:
+        return cbor2.dumps(obj)
+
+    def loads(self, buffer: bytes):
+        return cbor2.loads(buffer)
+
+
+JSON = JSONEncoder()
+ENCODERS: Dict[str, Encoder] = {}
+
+
+def register(encoder: Encoder) -> None:
+    ENCODERS[encoder.name] = encoder
+
+
+def get(name: str) -> Optional[Encoder]:
+    return ENCODERS.get(name)
+
+
+def from_subprotocol(subprotocol: str) -> Optional[Encoder]:
+    for encoder in ENCODERS.values():
+        if encoder.subprotocol == subprotocol:
+            return encoder
+
+
+register(JSON)
+if msgpack:
+    register(MsgpackEncoder())
+if cbor2:
+    register(CBOREncoder())
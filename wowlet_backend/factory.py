@@ -5,20 +5,19 @@
 import json
 import asyncio
 from typing import List, Set
-from datetime import datetime
 
 from quart import Quart
 from quart_session import Session
 import aioredis
 
+from wowlet_backend.fanout import ClientQueue
 from wowlet_backend.utils import current_worker_thread_is_primary, print_banner
 import settings
 
-now = datetime.now()
 app: Quart = None
 cache = None
 user_agents: List[str] = None
-connected_websockets: Set[asyncio.Queue] = set()
+connected_websockets: Set[ClientQueue] = set()
 _is_primary_worker_thread = False
 
 
@@ -35,22 +34,34 @@ async def _setup_user_agents(app: Quart):
         user_agents = [l.strip() for l in f.readlines() if l.strip()]
 
 
-async def _setup_cache(app: Quart):
-    global cache
+def _redis_opts() -> dict:
     # Each coin has it's own Redis DB index; `redis-cli -n $INDEX`
     db = {"xmr": 0, "wow": 1, "aeon": 2, "trtl": 3, "msr": 4, "xhv": 5, "loki": 6}[settings.COIN_SYMBOL]
-    data = {
+    return {
         "address": settings.REDIS_ADDRESS,
         "db": db,
         "password": settings.REDIS_PASSWORD if settings.REDIS_PASSWORD else None
     }
 
-    cache = await aioredis.create_redis_pool(**data)
+
+async def _setup_cache(app: Quart):
+    global cache
+    cache = await aioredis.create_redis_pool(**_redis_opts())
     app.config['SESSION_TYPE'] = 'redis'
     app.config['SESSION_REDIS'] = cache
     Session(app)
 
 
+async def _setup_pubsub(app: Quart):
+    """Every worker subscribes to task results published by
+    the primary worker, and fans them out to its own clients."""
+    if not settings.WS_PUBSUB:
+        return
+
+    from wowlet_backend.fanout import listen
+    asyncio.create_task(listen(**_redis_opts()))
+
+
 async def _setup_tasks(app: Quart):
     """Schedules a series of tasks at an interval."""
     if not _is_primary_worker_thread:
@@ -59,7 +70,8 @@ async def _setup_tasks(app: Quart):
     from wowlet_backend.tasks import (
         BlockheightTask, HistoricalPriceTask, FundingProposalsTask,
         CryptoRatesTask, FiatRatesTask, RedditTask, RPCNodeCheckTask,
-        XmrigTask, SuchWowTask, WowletReleasesTask, ForumThreadsTask)
+        XmrigTask, SuchWowTask, WowletReleasesTask, ForumThreadsTask,
+        PinPoolTask)
 
     asyncio.create_task(BlockheightTask().start())
     asyncio.create_task(HistoricalPriceTask().start())
@@ -71,6 +83,7 @@ async def _setup_tasks(app: Quart):
     asyncio.create_task(SuchWowTask().start())
     asyncio.create_task(WowletReleasesTask().start())
     asyncio.create_task(ForumThreadsTask().start())
+    asyncio.create_task(PinPoolTask().start())
 
     if settings.COIN_SYMBOL in ["xmr", "wow"]:
         asyncio.create_task(FundingProposalsTask().start())
@@ -109,6 +122,7 @@ def create_app():
         await _setup_cache(app)
         await _setup_nodes(app)
         await _setup_user_agents(app)
+        await _setup_pubsub(app)
         await _setup_tasks(app)
 
         import wowlet_backend.routes
@@ -0,0 +1,460 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import os
+import json
+import time
+import asyncio
+from typing import Dict, List, Set, Iterable, Callable, Awaitable
+from collections import deque, Counter, defaultdict
+
+import aioredis
+
+import settings
+from wowlet_backend.encoders import Encoder, JSON
+
+# per-worker fan-out counters, see `stats()`
+counters = Counter()
+
+# clients that never used `subscribe()`/`unsubscribe()` receive every cmd,
+# the others are only found in the subscriber sets of their topics.
+_all_topics: Set['ClientQueue'] = set()
+_subscribers: Dict[str, Set['ClientQueue']] = defaultdict(set)
+
+# updates held back during the coalescing window, see `deliver()`
+_pending: Dict[str, 'Update'] = {}
+_flush_handle: asyncio.TimerHandle = None
+
+
+class SlowConsumer(Exception):
+    """Raised by `ClientQueue.get()` once the client has been evicted."""
+
+
+class ClientQueue:
+    """
+    Bounded send queue for a single websocket connection.
+
+    Updates are queued per `cmd`. When the queue is full, older
+    updates for a `cmd` are superseded by the newest one (task results
+    are full states, so nothing is lost). A client that keeps the queue
+    full for longer than `max_lag` seconds is evicted, see `serve()`.
+
+    Clients that negotiated delta mode (see `WebsocketParse.hello`)
+    receive a patch instead of the full result, but only when they
+    hold the state the patch applies to. Clients that negotiated batch
+    mode receive all pending updates in a single `batch` frame.
+
+    Frames are JSON unless the client negotiated another `encoder`.
+    """
+    def __init__(self, maxsize: int = 32, max_lag: int = 120):
+        self.maxsize = maxsize
+        self.max_lag = max_lag
+        self.evicted = False
+
+        # delta mode; last `Update.seq` sent, per cmd
+        self.delta = False
+        self.seqs: Dict[str, int] = {}
+
+        # None means all topics
+        self.topics: Set[str] = None
+
+        self.batch = False
+        self.encoder: Encoder = JSON
+
+        self._frames = deque()
+        self._wakeup = asyncio.Event()
+        self._evicted = asyncio.Event()
+        self._lagging_since: float = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, update: 'Update') -> None:
+        if self.evicted:
+            return
+
+        self._frames.append(update)
+        if len(self._frames) > self.maxsize:
+            counters["frames_dropped"] += self._compact()
+            if not self._lagging_since:
+                self._lagging_since = time.monotonic()
+
+        if len(self._frames) > self.maxsize:
+            # distinct commands alone exceed the queue depth
+            self.evict()
+            return
+
+        if self._lagging_since and time.monotonic() - self._lagging_since > self.max_lag:
+            self.evict()
+            return
+
+        self._wakeup.set()
+
+    async def get(self) -> bytes:
+        while not self._frames:
+            if self.evicted:
+                raise SlowConsumer()
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+        if self.evicted:
+            raise SlowConsumer()
+
+        if self.batch and len(self._frames) > 1:
+            # last-writer-wins per cmd
+            self._compact()
+            updates = list(self._frames)
+            self._frames.clear()
+            self._lagging_since = None
+
+            frames = [self._select(update) for update in updates]
+            if self.encoder is JSON:
+                return splice_batch(frames)
+            return self.encoder.dumps({"cmd": "batch", "data": [update.decoded(frame)
+                                                                for update, frame in zip(updates, frames)]})
+
+        update = self._frames.popleft()
+        if len(self._frames) <= self.maxsize // 2:
+            # caught up
+            self._lagging_since = None
+        return update.transcode(self._select(update), self.encoder)
+
+    def enable_delta(self) -> None:
+        # next update per cmd will be a full frame to sync against
+        self.delta = True
+        self.seqs.clear()
+
+    def _select(self, update: 'Update') -> bytes:
+        if not self.delta:
+            return update.frame
+
+        last = self.seqs.get(update.cmd)
+        self.seqs[update.cmd] = update.seq
+        if update.patch and update.seq and last == update.seq - 1:
+            counters["patches_sent"] += 1
+            return update.patch
+        return update.frame
+
+    def evict(self) -> None:
+        if self.evicted:
+            return
+        self.evicted = True
+        self._frames.clear()
+        self._wakeup.set()
+        self._evicted.set()
+        counters["clients_evicted"] += 1
+
+    async def wait_evicted(self) -> None:
+        await self._evicted.wait()
+
+    def _compact(self) -> int:
+        """Keep only the newest update per `cmd`, preserving order."""
+        seen = set()
+        frames = deque()
+        for update in reversed(self._frames):
+            if update.cmd in seen:
+                continue
+            seen.add(update.cmd)
+            frames.appendleft(update)
+
+        dropped = len(self._frames) - len(frames)
+        self._frames = frames
+        return dropped
+
+
+async def serve(queue: ClientQueue, send: Callable[[bytes], Awaitable], receive: Awaitable) -> None:
+    """Write the queued frames of a websocket connection with `send`,
+    alongside its `receive` loop; returns, cancelling both, when either
+    one ends or the client is evicted. A client that stopped reading
+    blocks `send` rather than `queue.get()`, so eviction also interrupts
+    a pending `send`, and a `send` that takes longer than `max_lag`
+    evicts the client."""
+    async def tx():
+        while True:
+            try:
+                frame = await queue.get()
+            except SlowConsumer:
+                return
+            try:
+                await asyncio.wait_for(send(frame), queue.max_lag)
+            except asyncio.TimeoutError:
+                queue.evict()
+                return
+
+    tasks = [asyncio.ensure_future(receive), asyncio.ensure_future(tx()),
+             asyncio.ensure_future(queue.wait_evicted())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def splice_batch(frames: List[bytes]) -> bytes:
+    """Several frames as one `{"cmd": "batch", "data": [frame, ...]}` frame."""
+    return b'{"cmd": "batch", "data": [' + b', '.join(frames) + b']}'
+
+
+class Update:
+    """
+    A task result as it travels to the websocket clients: the full
+    frame and, when the previous result is known, a JSON-patch style
+    frame against sequence number `seq - 1`. Both frames are encoded
+    once (per encoding) and shared by all clients.
+    """
+    __slots__ = ("cmd", "seq", "frame", "patch", "_decoded", "_transcoded")
+
+    def __init__(self, cmd: str, seq: int, frame: bytes, patch: bytes = b""):
+        self.cmd = cmd
+        self.seq = seq
+        self.frame = frame
+        self.patch = patch
+        self._decoded: Dict[bool, object] = {}
+        self._transcoded: Dict[tuple, bytes] = {}
+
+    def decoded(self, frame: bytes):
+        """`frame` (either `self.frame` or `self.patch`), decoded once."""
+        key = frame is self.patch
+        if key not in self._decoded:
+            self._decoded[key] = json.loads(frame)
+        return self._decoded[key]
+
+    def transcode(self, frame: bytes, encoder: Encoder) -> bytes:
+        """`frame` (either `self.frame` or `self.patch`) in another encoding."""
+        if encoder is JSON:
+            return frame
+
+        key = (frame is self.patch, encoder.name)
+        if key not in self._transcoded:
+            self._transcoded[key] = encoder.dumps(self.decoded(frame))
+        return self._transcoded[key]
+
+    @classmethod
+    def create(cls, cmd: str, seq: int, data, previous=None):
+        frame = json.dumps({"cmd": cmd, "seq": seq, "data": data}).encode()
+        patch = b""
+        if seq and previous:
+            ops = json_diff(previous, data)
+            patch = json.dumps({"cmd": cmd, "seq": seq, "patch": ops}).encode()
+            if len(patch) >= len(frame):
+                patch = b""
+        return cls(cmd, seq, frame, patch)
+
+    def pack(self) -> bytes:
+        # frames are compact JSON and never contain a raw newline
+        return b"\n".join([self.cmd.encode(), str(self.seq).encode(), self.frame, self.patch])
+
+    @classmethod
+    def unpack(cls, message: bytes):
+        cmd, seq, frame, patch = message.split(b"\n", 3)
+        return cls(cmd.decode(), int(seq), frame, patch)
+
+
+def json_diff(a, b, path: str = "") -> List[dict]:
+    """Minimal RFC 6902 (JSON Patch) operations that turn `a` into `b`.
+    Lists are compared by index; items are appended to or removed
+    from the tail."""
+    if type(a) != type(b):
+        return [{"op": "replace", "path": path, "value": b}]
+
+    ops = []
+    if isinstance(a, dict):
+        for k in a:
+            if k not in b:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(k)}"})
+        for k, v in b.items():
+            if k not in a:
+                ops.append({"op": "add", "path": f"{path}/{_escape(k)}", "value": v})
+            else:
+                ops += json_diff(a[k], v, f"{path}/{_escape(k)}")
+    elif isinstance(a, list):
+        for i in range(min(len(a), len(b))):
+            ops += json_diff(a[i], b[i], f"{path}/{i}")
+        for i in range(len(a), len(b)):
+            ops.append({"op": "add", "path": f"{path}/{i}", "value": b[i]})
+        for i in reversed(range(len(b), len(a))):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+    elif a != b:
+        ops.append({"op": "replace", "path": path, "value": b})
+    return ops
+
+
+def _escape(key) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+async def broadcast(cmd: str, data, previous=None) -> None:
+    """Serialize a task result exactly once (plus a patch against
+    `previous`) and publish it on the Redis broadcast channel. Every
+    worker (see `listen()`) hands the same frames to its own clients,
+    the `tx()` loop in `routes.ws` writes them as-is."""
+    from wowlet_backend.factory import app, cache
+
+    # sequence numbers are global, so that they survive a restart of the primary worker
+    try:
+        seq = await cache.incr(f"seq_{cmd}")
+    except Exception as ex:
+        app.logger.error(f"Redis INCR error with key 'seq_{cmd}': {ex}")
+        seq = 0
+
+    update = Update.create(cmd, seq, data, previous)
+    if not settings.WS_PUBSUB:
+        deliver(update)
+        return
+
+    try:
+        await cache.publish(channel("broadcast"), update.pack())
+    except Exception as ex:
+        app.logger.error(f"Redis PUBLISH error, delivering locally: {ex}")
+        deliver(update)
+
+
+def deliver(update: Update) -> None:
+    """Fan out an update to the websocket clients of this worker. With
+    `WS_COALESCE_MS` set, updates arriving within that window are held
+    back (last-writer-wins per cmd) and handed out together."""
+    global _flush_handle
+    if not settings.WS_COALESCE_MS:
+        _fanout(update)
+        return
+
+    if update.cmd in _pending:
+        counters["updates_coalesced"] += 1
+    _pending[update.cmd] = update
+
+    if _flush_handle is None:
+        loop = asyncio.get_event_loop()
+        _flush_handle = loop.call_later(settings.WS_COALESCE_MS / 1000, _flush)
+
+
+def _flush() -> None:
+    global _flush_handle
+    _flush_handle = None
+    updates = list(_pending.values())
+    _pending.clear()
+    for update in updates:
+        _fanout(update)
+
+
+def _fanout(update: Update) -> None:
+    for queue in _all_topics:
+        queue.put(update)
+    for queue in _subscribers.get(update.cmd, ()):
+        queue.put(update)
+
+
+def register(queue: ClientQueue) -> None:
+    from wowlet_backend.factory import connected_websockets
+    connected_websockets.add(queue)
+    _all_topics.add(queue)
+
+
+def unregister(queue: ClientQueue) -> None:
+    from wowlet_backend.factory import connected_websockets
+    connected_websockets.discard(queue)
+    _all_topics.discard(queue)
+    for topic in queue.topics or ():
+        _unsubscribe(queue, topic)
+
+
+def topics() -> Dict[str, str]:
+    """All names a client can subscribe to, mapped to the
+    cmd their updates are broadcast under."""
+    from wowlet_backend.snapshot import KEYS, LEGACY_KEYS, websocket_cmd
+    rtn = {key: websocket_cmd(key) for key in KEYS if websocket_cmd(key)}
+    rtn.update({alias: rtn[key] for alias, key in LEGACY_KEYS.items() if key in rtn})
+    return rtn
+
+
+def subscribe(queue: ClientQueue, names: Iterable[str]) -> Set[str]:
+    """Limit a client to the given topics (additive); returns the
+    cmds the client is subscribed to."""
+    if queue.topics is None:
+        _all_topics.discard(queue)
+        queue.topics = set()
+
+    available = topics()
+    for topic in {available[name] for name in names if name in available}:
+        queue.topics.add(topic)
+        _subscribers[topic].add(queue)
+    return queue.topics
+
+
+def unsubscribe(queue: ClientQueue, names: Iterable[str]) -> Set[str]:
+    if queue.topics is None:
+        subscribe(queue, topics())
+
+    available = topics()
+    for topic in {available[name] for name in names if name in available} & queue.topics:
+        queue.topics.discard(topic)
+        _unsubscribe(queue, topic)
+    return queue.topics
+
+
+def _unsubscribe(queue: ClientQueue, topic: str) -> None:
+    subscribers = _subscribers.get(topic)
+    if subscribers is None:
+        return
+    subscribers.discard(queue)
+    if not subscribers:
+        del _subscribers[topic]
+
+
+def channel(name: str) -> str:
+    # Redis pub/sub channels are not scoped to a DB index
+    return f"wowlet:{settings.COIN_SYMBOL}:{name}"
+
+
+async def listen(**redis_opts) -> None:
+    """Subscribe this worker to the broadcast channel and deliver
+    incoming frames to local clients. Also listens for snapshot
+    invalidations. Runs on every worker; only the primary
+    worker runs the tasks that publish."""
+    from wowlet_backend.factory import app
+    from wowlet_backend import snapshot
+
+    async def broadcasts(ch):
+        async for message in ch.iter():
+            counters["pubsub_messages"] += 1
+            deliver(Update.unpack(message))
+
+    async def invalidations(ch):
+        async for message in ch.iter():
+            snapshot.expire(int(message))
+
+    while True:
+        conn = None
+        try:
+            conn = await aioredis.create_redis(**redis_opts)
+            ch_broadcast, ch_invalidate = await conn.subscribe(channel("broadcast"), channel("invalidate"))
+            app.logger.info(f"Subscribed to {ch_broadcast.name.decode()}")
+
+            # any snapshot built before we subscribed may be stale
+            snapshot.reset()
+            await asyncio.gather(broadcasts(ch_broadcast), invalidations(ch_invalidate))
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            app.logger.error(f"Redis pub/sub error: {ex}")
+        finally:
+            if conn:
+                conn.close()
+
+        await asyncio.sleep(1)
+
+
+def stats() -> dict:
+    """Fan-out counters for this worker, used to size
+    `WS_QUEUE_SIZE` and `WS_QUEUE_MAX_LAG`."""
+    from wowlet_backend.factory import connected_websockets
+    return {
+        "pid": os.getpid(),
+        "clients": len(connected_websockets),
+        "queued": sum(len(queue) for queue in connected_websockets),
+        "pubsub_messages": counters["pubsub_messages"],
+        "patches_sent": counters["patches_sent"],
+        "updates_coalesced": counters["updates_coalesced"],
+        "frames_dropped": counters["frames_dropped"],
+        "clients_evicted": counters["clients_evicted"]
+    }
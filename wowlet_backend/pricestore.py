@@ -0,0 +1,153 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import os
+import sys
+import math
+import mmap
+import struct
+from array import array
+from datetime import date
+from typing import Iterator, Optional, Sequence, Tuple
+
+import aiofiles
+
+
+class PriceStore:
+    """
+    Daily prices on disk as a fixed-stride array of little-endian float64,
+    indexed by days since `genesis`; days without a price are NaN. The
+    file is memory-mapped, so range queries are slices and neither startup
+    time nor memory grow with the history.
+
+    header: magic, version, stride, genesis (proleptic ordinal), amount of days
+    """
+    MAGIC = b"WHPS"
+    VERSION = 1
+    STRIDE = 8
+    HEADER = struct.Struct("<4sHHII")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.genesis: date = None
+
+        self._mmap: mmap.mmap = None
+        self._prices: memoryview = None
+
+    def __len__(self):
+        return len(self._prices) if self._prices is not None else 0
+
+    def open(self) -> bool:
+        """(Re)map the file; returns False if it does not exist,
+        raises `ValueError` when it is corrupt."""
+        self.close()
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            genesis = self._validate(buffer)
+        except ValueError:
+            buffer.close()
+            raise
+
+        view = memoryview(buffer)[self.HEADER.size:]
+        if sys.byteorder == "little":
+            self._prices = view.cast("d")
+        else:
+            prices = array("d", view.tobytes())
+            prices.byteswap()
+            self._prices = memoryview(prices)
+
+        self._mmap = buffer
+        self.genesis = date.fromordinal(genesis)
+        return True
+
+    def _validate(self, buffer: mmap.mmap) -> int:
+        if len(buffer) < self.HEADER.size:
+            raise ValueError(f"{self.path}: truncated header")
+        magic, version, stride, genesis, days = self.HEADER.unpack_from(buffer)
+        if magic != self.MAGIC or version != self.VERSION or stride != self.STRIDE:
+            raise ValueError(f"{self.path}: unknown format")
+        if len(buffer) != self.HEADER.size + days * stride:
+            raise ValueError(f"{self.path}: expected {days} days, file size mismatch")
+        return genesis
+
+    def close(self) -> None:
+        self._prices = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # a slice is still referenced; unmapped once it is collected
+            self._mmap = None
+
+    @property
+    def last_day(self) -> Optional[date]:
+        if not len(self):
+            return
+        return date.fromordinal(self.genesis.toordinal() + len(self) - 1)
+
+    def index(self, day: date) -> int:
+        return day.toordinal() - self.genesis.toordinal()
+
+    def price(self, day: date) -> Optional[float]:
+        if not len(self):
+            return
+        i = self.index(day)
+        if not 0 <= i < len(self):
+            return
+        price = self._prices[i]
+        return None if math.isnan(price) else price
+
+    def range(self, start: date, end: date) -> memoryview:
+        """Prices for `start` up to and including `end`, clamped to the store."""
+        a = max(self.index(start), 0)
+        b = min(self.index(end) + 1, len(self))
+        return self._prices[a:max(a, b)]
+
+    def items(self, start: date = None, end: date = None) -> Iterator[Tuple[date, float]]:
+        """(day, price) for days that have a price."""
+        if not len(self):
+            return
+        start = start or self.genesis
+        offset = max(self.index(start), 0) + self.genesis.toordinal()
+        for i, price in enumerate(self.range(start, end or self.last_day)):
+            if not math.isnan(price):
+                yield date.fromordinal(offset + i), price
+
+    @classmethod
+    async def write(cls, path: str, genesis: date, prices: Sequence[float]) -> None:
+        """Atomically replace the file at `path`."""
+        prices = array("d", prices)
+        if sys.byteorder != "little":
+            prices.byteswap()
+
+        header = cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.STRIDE, genesis.toordinal(), len(prices))
+        async with aiofiles.open(f"{path}.tmp", mode="wb") as f:
+            await f.write(header + prices.tobytes())
+        os.replace(f"{path}.tmp", path)
+
+    async def extend(self, start: int, prices: Sequence[float]) -> None:
+        """Write `prices` from index `start` (at most `len(self)`), overwriting
+        and/or appending, and remap; never shrinks the store. The header is
+        written last; an interrupted write fails validation on the next `open()`."""
+        if not 0 <= start <= len(self):
+            raise ValueError(f"{self.path}: can not extend at index {start}")
+
+        genesis = self.genesis
+        days = max(start + len(prices), len(self))
+        prices = array("d", prices)
+        if sys.byteorder != "little":
+            prices.byteswap()
+
+        self.close()
+        async with aiofiles.open(self.path, mode="r+b") as f:
+            await f.seek(self.HEADER.size + start * self.STRIDE)
+            await f.write(prices.tobytes())
+            await f.seek(0)
+            await f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.STRIDE, genesis.toordinal(), days))
+        self.open()
@@ -0,0 +1,135 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import time
+import asyncio
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Optional
+
+import aiofiles
+
+import settings
+
+# `height:timestamp` lines, as written by `utils/generate_heights_db.py`
+PATH = f"data/restore_heights_{settings.COIN_SYMBOL}_{settings.COIN_MODE}.txt"
+
+# live heights are kept at roughly the same interval as the file
+STEP = 1500
+
+
+class RestoreHeights:
+    """
+    Sorted (height, timestamp) pairs in two compact arrays; maps a
+    date to a restore height (the last known height before it) and a
+    height to its approximate date by binary search. The last pair may
+    be a moving tip, the latest height seen, which is replaced until it
+    is `STEP` blocks further.
+    """
+    def __init__(self):
+        self.heights = array("q")
+        self.timestamps = array("q")
+        self._tip = False
+
+    def __len__(self):
+        return len(self.heights)
+
+    @classmethod
+    def from_lines(cls, lines):
+        pairs = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            height, timestamp = line.split(":")
+            pairs.append((int(height), int(timestamp)))
+
+        index = cls()
+        for height, timestamp in sorted(pairs):
+            index.add(height, timestamp, tip=False)
+        return index
+
+    def add(self, height: int, timestamp: int, tip: bool = True) -> None:
+        """Block timestamps are not strictly increasing; pairs that
+        would break the ordering of either array are skipped."""
+        if self.heights and (height <= self.heights[-1] or timestamp <= self.timestamps[-1]):
+            return
+
+        if self._tip and len(self) > 1 and height - self.heights[-2] < STEP:
+            self.heights[-1], self.timestamps[-1] = height, timestamp
+        else:
+            self.heights.append(height)
+            self.timestamps.append(timestamp)
+        self._tip = tip
+
+    def height_at(self, timestamp: int) -> Optional[int]:
+        """The last known height at or before `timestamp`; None before
+        the first one. Not interpolated: block times vary, and a height
+        that is too high skips the first transactions of a wallet."""
+        if not self:
+            return
+        i = bisect_right(self.timestamps, timestamp)
+        if i == 0:
+            return
+        return self.heights[i - 1]
+
+    def timestamp_at(self, height: int) -> Optional[int]:
+        """The (approximate) timestamp of `height`, None if it is
+        outside of the known range."""
+        if not self or not self.heights[0] <= height <= self.heights[-1]:
+            return
+        i = bisect_left(self.heights, height)
+        if self.heights[i] == height:
+            return self.timestamps[i]
+        return int(self._interpolate(height, self.heights, self.timestamps, i))
+
+    @staticmethod
+    def _interpolate(x: int, xs: array, ys: array, i: int) -> float:
+        x0, x1, y0, y1 = xs[i - 1], xs[i], ys[i - 1], ys[i]
+        return y0 + (x - x0) * (y1 - y0) / (x1 - x0)
+
+
+_index: RestoreHeights = None
+_loaded = False
+_lock: asyncio.Lock = None
+
+
+async def current() -> Optional[RestoreHeights]:
+    """The index of this worker, loaded once and extended with
+    the blockheight of `COIN_MODE` from the current snapshot. None
+    when `PATH` could not be loaded; live heights alone are too
+    sparse to restore from."""
+    global _index, _loaded, _lock
+    from wowlet_backend.factory import app
+    from wowlet_backend.snapshot import current as snapshot
+
+    if _index is None:
+        if _lock is None:
+            _lock = asyncio.Lock()
+        async with _lock:
+            if _index is None:
+                try:
+                    _index = await _load()
+                    _loaded = True
+                except FileNotFoundError:
+                    app.logger.error(f"restore heights file {PATH} is missing, restoreHeight is disabled; "
+                                     f"generate it with utils/generate_heights_db.py")
+                    _index = RestoreHeights()
+                except Exception as ex:
+                    app.logger.error(f"could not load restore heights from {PATH}, restoreHeight is disabled: {ex}")
+                    _index = RestoreHeights()
+
+    if not _loaded:
+        return
+
+    heights = (await snapshot()).data.get("blockheights") or {}
+    height = heights.get(settings.COIN_MODE)
+    if height:
+        _index.add(height, int(time.time()))
+    return _index
+
+
+async def _load() -> RestoreHeights:
+    async with aiofiles.open(PATH, mode="r") as f:
+        return RestoreHeights.from_lines((await f.read()).splitlines())
@@ -3,21 +3,46 @@
 # Copyright (c) 2020, dsc@xmr.pm
 
 import os
-import asyncio
-import json
 
-from quart import websocket, jsonify, send_from_directory
+from quart import websocket, request, jsonify, send_from_directory
 
 import settings
 from wowlet_backend.factory import app
-from wowlet_backend.wsparse import WebsocketParse
-from wowlet_backend.utils import collect_websocket, feather_data
+from wowlet_backend.wsparse import WebsocketParse, pin_stats
+from wowlet_backend import encoders
+from wowlet_backend.fanout import serve, stats
+from wowlet_backend.snapshot import ENCODINGS, current
+from wowlet_backend.utils import collect_websocket, accept_encoding, etag_matches
 
 
 @app.route("/")
 async def root():
-    data = await feather_data()
-    return jsonify(data)
+    snapshot = await current()
+    encoding = accept_encoding(request.headers.get("Accept-Encoding"), ENCODINGS)
+    etag = snapshot.etag(encoding)
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding"
+    }
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return b"", 304, headers
+
+    headers["Content-Type"] = "application/json"
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return snapshot.encoded(encoding), 200, headers
+
+
+@app.route("/stats")
+async def ws_stats():
+    """Websocket fan-out counters of this worker, PIN space occupancy"""
+    return jsonify({
+        "websockets": stats(),
+        "pins": await pin_stats()
+    })
 
 
 @app.route("/suchwow/<path:name>")
@@ -30,44 +55,42 @@ async def suchwow(name: str):
 @app.websocket('/ws')
 @collect_websocket
 async def ws(queue):
-    data = await feather_data()
+    # optional: negotiate the message encoding via subprotocol
+    for subprotocol in websocket.requested_subprotocols:
+        encoder = encoders.from_subprotocol(subprotocol)
+        if encoder:
+            queue.encoder = encoder
+            await websocket.accept(subprotocol=subprotocol)
+            break
+
+    snapshot = await current()
 
     # blast available data on connect
-    for task_key, task_value in data.items():
-        if not task_value:
-            continue
-        await websocket.send(json.dumps({"cmd": task_key, "data": task_value}).encode())
+    for frame in snapshot.frames_for(queue.encoder):
+        await websocket.send(frame)
 
     async def rx():
         while True:
             buffer = await websocket.receive()
             try:
-                blob = json.loads(buffer)
+                # replies use the encoding of the request; text frames are JSON
+                encoder = queue.encoder if isinstance(buffer, bytes) else encoders.JSON
+                blob = encoder.loads(buffer)
                 if "cmd" not in blob:
                     continue
                 cmd = blob.get('cmd')
                 _data = blob.get('data')
-                result = await WebsocketParse.parser(cmd, _data)
+                result = await WebsocketParse.parser(cmd, _data, client=queue)
                 if result:
-                    rtn = json.dumps({"cmd": cmd, "data": result}).encode()
-                    await websocket.send(rtn)
+                    await websocket.send(encoder.frame(cmd, result))
             except Exception as ex:
                 continue
 
-    async def tx():
-        while True:
-            data = await queue.get()
-            payload = json.dumps(data).encode()
-            await websocket.send(payload)
-
-    # bidirectional async rx and tx loops
-    consumer_task = asyncio.ensure_future(rx())
-    producer_task = asyncio.ensure_future(tx())
-    try:
-        await asyncio.gather(consumer_task, producer_task)
-    finally:
-        consumer_task.cancel()
-        producer_task.cancel()
+    # bidirectional async rx and tx loops, when either
+    # one returns or the client is evicted we disconnect.
+    await serve(queue, websocket.send, rx())
+    if queue.evicted:
+        app.logger.debug("evicted slow websocket client")
 
 
 @app.errorhandler(403)
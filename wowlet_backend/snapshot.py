@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+import json
+import gzip
+import time
+import asyncio
+import hashlib
+from typing import Dict, List, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import settings
+from wowlet_backend.encoders import Encoder, JSON, splice_frame
+
+# Redis keys written by `WowletTask`, served to Feather wallet clients
+KEYS = ["blockheights", "funding_proposals", "crypto_rates", "fiat_rates", "reddit", "rpc_nodes",
+        "xmrig", "xmrto_rates", "suchwow", "forum", "wowlet_releases"]
+
+# @TODO: for backward-compat reasons we're including some legacy keys which can be removed after 1.0 release
+LEGACY_KEYS = {"nodes": "rpc_nodes", "ccs": "funding_proposals", "wfs": "funding_proposals"}
+
+# live updates of these keys are broadcast under a different cmd, the others
+# under their own name; None when this coin has no such cmd. See `websocket_cmd()`.
+BROADCAST_CMDS = {
+    "rpc_nodes": "nodes",
+    "funding_proposals": {"xmr": "ccs", "wow": "wfs"}.get(settings.COIN_SYMBOL)
+}
+
+
+def websocket_cmd(key: str) -> Optional[str]:
+    """The cmd the live updates of `key` are broadcast under; both
+    `WowletTask._websocket_cmd` and the topics of `fanout` use it."""
+    return BROADCAST_CMDS.get(key, key)
+
+
+# bumped (INCR) every time a task writes a changed result for one of `KEYS`
+VERSION_KEY = "data_version"
+
+# a snapshot is also rebuilt after this many seconds, so
+# that cache keys expiring in Redis are picked up.
+MAX_AGE = 30
+
+
+class Snapshot:
+    """
+    Immutable, per-worker copy of the task results; holds the parsed
+    dict, the encoded JSON body and the websocket frames that are sent
+    to clients on connect. Must not be mutated.
+    """
+    def __init__(self, version: int, data: dict, body: bytes, frames: List[bytes]):
+        self.version = version
+        self.data = data
+        self.body = body
+        self.frames = frames
+        self.created = time.monotonic()
+
+        self.digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+        self._compressed: Dict[str, bytes] = {}
+        self._frames: Dict[str, List[bytes]] = {}
+
+    def frames_for(self, encoder: Encoder) -> List[bytes]:
+        """Connect-time frames in the given encoding, encoded
+        at most once per snapshot."""
+        if encoder is JSON:
+            return self.frames
+        if encoder.name not in self._frames:
+            self._frames[encoder.name] = [encoder.dumps(json.loads(frame)) for frame in self.frames]
+        return self._frames[encoder.name]
+
+    def etag(self, encoding: str = "identity") -> str:
+        """Strong ETag, distinct per content-encoding."""
+        if encoding == "identity":
+            return f'"{self.version}-{self.digest}"'
+        return f'"{self.version}-{self.digest}-{encoding}"'
+
+    def encoded(self, encoding: str = "identity") -> bytes:
+        """The body in the given content-encoding, compressed
+        at most once per snapshot."""
+        if encoding == "identity":
+            return self.body
+        if encoding not in self._compressed:
+            if encoding == "gzip":
+                self._compressed[encoding] = gzip.compress(self.body, compresslevel=9)
+            elif encoding == "br" and brotli:
+                self._compressed[encoding] = brotli.compress(self.body, mode=brotli.MODE_TEXT)
+            else:
+                raise ValueError(f"unsupported encoding '{encoding}'")
+        return self._compressed[encoding]
+
+    @classmethod
+    def from_raw(cls, version: int, raw: Dict[str, Optional[bytes]]):
+        """Build from the raw Redis values (JSON, as written by
+        `WowletTask.cache_set`); the body is spliced, not re-encoded."""
+        raw = dict(raw)
+        for alias, key in LEGACY_KEYS.items():
+            raw[alias] = raw[key]
+
+        data = {k: json.loads(v) if v else None for k, v in raw.items()}
+        body = b"{" + b", ".join(json.dumps(k).encode() + b": " + (v if v else b"null")
+                                for k, v in raw.items()) + b"}"
+
+        # connect-time frames; legacy aliases share the same encoded data
+        frames = [splice_frame(k, v) for k, v in raw.items() if data[k]]
+        return cls(version, data, body, frames)
+
+
+# available content-encodings for `Snapshot.encoded()`, in order of preference
+ENCODINGS = ["br", "gzip"] if brotli else ["gzip"]
+
+_snapshot: Snapshot = None
+_latest_version = 0
+_lock: asyncio.Lock = None
+
+
+async def current() -> Snapshot:
+    """Returns the snapshot of this worker, only hits
+    Redis when the snapshot was invalidated."""
+    global _snapshot, _latest_version, _lock
+    if _fresh(_snapshot):
+        return _snapshot
+
+    if _lock is None:
+        _lock = asyncio.Lock()
+
+    async with _lock:
+        # concurrent callers wait for a single rebuild
+        if not _fresh(_snapshot):
+            expected = _latest_version
+            _snapshot = await _build()
+            if _snapshot.version < expected == _latest_version:
+                # `VERSION_KEY` restarted (FLUSHDB, Redis restart)
+                _latest_version = _snapshot.version
+    return _snapshot
+
+
+def _fresh(snapshot: Snapshot) -> bool:
+    return snapshot is not None and \
+        snapshot.version >= _latest_version and \
+        time.monotonic() - snapshot.created < MAX_AGE
+
+
+async def _build() -> Snapshot:
+    from wowlet_backend.factory import cache
+    version, *values = await cache.mget(VERSION_KEY, *KEYS)
+    version = int(version) if version else 0
+    return Snapshot.from_raw(version, dict(zip(KEYS, values)))
+
+
+def expire(version: int) -> None:
+    """Called by the pub/sub listener when a task wrote a new result."""
+    global _latest_version
+    if version < _latest_version:
+        # `VERSION_KEY` restarted (FLUSHDB, Redis restart)
+        reset()
+    _latest_version = max(_latest_version, version)
+
+
+def reset() -> None:
+    global _snapshot, _latest_version
+    _snapshot = None
+    _latest_version = 0
+
+
+async def invalidate() -> None:
+    """Called by a task after it wrote a changed result to
+    Redis; invalidates the snapshots of all workers."""
+    from wowlet_backend.factory import app, cache
+    from wowlet_backend.fanout import channel
+
+    try:
+        version = await cache.incr(VERSION_KEY)
+    except Exception as ex:
+        app.logger.error(f"Redis INCR error with key '{VERSION_KEY}': {ex}")
+        return
+
+    if not settings.WS_PUBSUB:
+        expire(version)
+        return
+
+    try:
+        await cache.publish(channel("invalidate"), str(version))
+    except Exception as ex:
+        app.logger.error(f"Redis PUBLISH error: {ex}")
+        expire(version)
@@ -38,8 +38,11 @@ class WowletTask:
         self._active = True
         self._running = False
 
+        # serializes `publish()`, created on first use (in the event loop)
+        self._publish_lock: asyncio.Lock = None
+
     async def start(self, *args, **kwargs):
-        from wowlet_backend.factory import app, connected_websockets
+        from wowlet_backend.factory import app
         if not self._active:
             # invalid task
             return
@@ -82,7 +85,30 @@ class WowletTask:
                     self._running = False
                     continue
 
+            await self.publish(result)
+
+            # optional: call completion function
+            if 'done' in self.__class__.__dict__:
+                await self.done(result)
+
+            await sleep()
+            self._running = False
+
+    async def publish(self, result: dict) -> None:
+        """Cache `result` and propagate it to websocket clients; also
+        usable by tasks that receive results outside of `task()`."""
+        from wowlet_backend.fanout import broadcast
+        from wowlet_backend.snapshot import invalidate
+
+        if self._publish_lock is None:
+            self._publish_lock = asyncio.Lock()
+
+        # compare, cache and broadcast as one step; a concurrent publish
+        # could otherwise compare against a stale cached result
+        async with self._publish_lock:
             # optional: propogate result to websocket peers
+            propagate = False
+            cached = None
             if self._websocket_cmd and result:
                 # but only when there is a change
                 normalize = lambda k: json.dumps(k, sort_keys=True, indent=4)
@@ -93,23 +119,13 @@ class WowletTask:
                     if normalize(cached) == normalize(result):
                         propagate = False
 
-                if propagate:
-                    for queue in connected_websockets:
-                        await queue.put({
-                            "cmd": self._websocket_cmd,
-                            "data": result
-                        })
-
             # optional: cache the result
             if self._cache_key and result:
                 await self.cache_set(self._cache_key, result, self._cache_expiry)
 
-            # optional: call completion function
-            if 'done' in self.__class__.__dict__:
-                await self.done(result)
-
-            await sleep()
-            self._running = False
+            if propagate:
+                await broadcast(self._websocket_cmd, result, previous=cached)
+                await invalidate()
 
     async def task(self, *args, **kwargs):
         raise NotImplementedError()
@@ -167,4 +183,5 @@ from wowlet_backend.tasks.rpc_nodes import RPCNodeCheckTask
 from wowlet_backend.tasks.xmrig import XmrigTask
 from wowlet_backend.tasks.suchwow import SuchWowTask
 from wowlet_backend.tasks.wowlet import WowletReleasesTask
-from wowlet_backend.tasks.forum import ForumThreadsTask
\ No newline at end of file
+from wowlet_backend.tasks.forum import ForumThreadsTask
+from wowlet_backend.tasks.pins import PinPoolTask
\ No newline at end of file
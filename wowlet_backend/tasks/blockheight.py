@@ -3,13 +3,71 @@
 # Copyright (c) 2020, dsc@xmr.pm
 
 import re
-from typing import Union
+import json
+import time
+import asyncio
+from typing import Dict, Union
 from collections import Counter
 from functools import partial
 
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
 import settings
-from wowlet_backend.utils import httpget, popularity_contest
+from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
+
+
+class SourceStats:
+    """Reputation of a blockheight source; exponentially weighted
+    moving averages of its latency, errors and agreement with the
+    consensus. Sources that keep failing are skipped for a while."""
+    ALPHA = 0.2
+    BACKOFF_AFTER = 3  # consecutive failures
+    MAX_BACKOFF = 3600
+
+    def __init__(self):
+        self.latency: float = None
+        self.errors = 0.0
+        self.agreement = 1.0
+        self.failures = 0
+        self.skip_until = 0.0
+
+    def _ewma(self, avg: float, value: float) -> float:
+        return value if avg is None else avg + self.ALPHA * (value - avg)
+
+    def success(self, latency: float) -> None:
+        self.latency = self._ewma(self.latency, latency)
+        self.errors = self._ewma(self.errors, 0)
+        self.failures = 0
+
+    def failure(self, latency: float, interval: int) -> None:
+        self.latency = self._ewma(self.latency, latency)
+        self.errors = self._ewma(self.errors, 1)
+        self.failures += 1
+        if self.failures >= self.BACKOFF_AFTER:
+            backoff = interval * 2 ** (self.failures - self.BACKOFF_AFTER)
+            self.skip_until = time.monotonic() + min(backoff, self.MAX_BACKOFF)
+
+    def cancelled(self, elapsed: float) -> None:
+        """Still busy when the quorum was reached; at least this slow."""
+        if self.latency is None or elapsed > self.latency:
+            self.latency = self._ewma(self.latency, elapsed)
+
+    def voted(self, agreed: bool) -> None:
+        self.agreement = self._ewma(self.agreement, float(agreed))
+
+    @property
+    def backed_off(self) -> bool:
+        return time.monotonic() < self.skip_until
+
+    @property
+    def score(self) -> float:
+        return self.agreement * (1 - self.errors) / (1 + (self.latency or 0))
 
 
 class BlockheightTask(WowletTask):
@@ -17,8 +75,13 @@ class BlockheightTask(WowletTask):
     Fetch latest blockheight using webcrawling. We pick the most popular
     height from a list of websites. Arguably this approach has benefits
     over querying a (local) Monero RPC instance, as that requires
-    maintenance, while this solution assumes that (at least) 2 websites
-    reports the correct height.
+    maintenance, while this solution assumes that (at least)
+    `BLOCKHEIGHT_QUORUM` websites report the correct height.
+
+    Optionally, a local daemon pushes new heights for `COIN_MODE` the
+    moment a block arrives (`BLOCKHEIGHT_ZMQ`, or by polling
+    `BLOCKHEIGHT_RPC`); scraping is then only the fallback for when
+    the daemon went quiet.
     """
     def __init__(self, interval: int = 60):
         super(BlockheightTask, self).__init__(interval)
@@ -26,7 +89,17 @@ class BlockheightTask(WowletTask):
         self._cache_key = "blockheights"
         self._cache_expiry = 90
 
-        self._websocket_cmd = "blockheights"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
+
+        # per source name, see `_fn_name()`
+        self._sources: Dict[str, SourceStats] = {}
+
+        # height of the local daemon, and when it was last heard of
+        self._daemon_height: int = None
+        self._daemon_seen: float = 0
+        self._daemon_max_age = 600
+        self._daemon_poll_interval = 2
+        self._daemon_task: asyncio.Task = None
 
         self._fns = {
             "xmr": {
@@ -80,34 +153,194 @@ class BlockheightTask(WowletTask):
             }
         }
 
+    async def start(self, *args, **kwargs):
+        if (settings.BLOCKHEIGHT_ZMQ or settings.BLOCKHEIGHT_RPC) and self._daemon_task is None:
+            self._daemon_task = asyncio.ensure_future(self._daemon_supervisor())
+        await super(BlockheightTask, self).start(*args, **kwargs)
+
     async def task(self) -> Union[dict, None]:
         from wowlet_backend.factory import app
         coin_network_types = ["mainnet", "stagenet", "testnet"]
         data = {t: 0 for t in coin_network_types}
 
-        for coin_network_type in coin_network_types:
-            if coin_network_type not in self._fns[settings.COIN_SYMBOL]:
-                continue
+        if self._daemon_fresh():
+            data[settings.COIN_MODE] = self._daemon_height
+        coin_network_types = [t for t in coin_network_types if t in self._fns[settings.COIN_SYMBOL] and not data[t]]
+        heights = await asyncio.gather(*[self._consensus(self._fns[settings.COIN_SYMBOL][t])
+                                         for t in coin_network_types])
+        for coin_network_type, height in zip(coin_network_types, heights):
+            if height:
+                data[coin_network_type] = height
 
-            heights = []
-            for fn in self._fns[settings.COIN_SYMBOL][coin_network_type]:
-                fn_name = fn.func.__name__ if isinstance(fn, partial) else fn.__name__
+        if data["mainnet"] == 0:  # only care about mainnet
+            app.logger.error(f"Failed to parse latest blockheight!")
+            return
 
-                try:
-                    result = await fn()
-                    heights.append(result)
-                except Exception as ex:
-                    app.logger.error(f"blockheight fetch failed from {fn_name}(): {ex}")
+        return data
+
+    async def _consensus(self, fns: list) -> Union[int, None]:
+        """Query the sources concurrently, best reputation first, return as
+        soon as `BLOCKHEIGHT_QUORUM` of them agree and cancel the rest. With
+        a `BLOCKHEIGHT_HEDGE_DELAY`, only as many sources as needed are
+        queried; another one is added when a source fails, disagrees, or
+        has not answered within the delay. Without a quorum, the votes are
+        weighted by how often each source agreed before."""
+        from wowlet_backend.factory import app
+        stats = {fn: self._sources.setdefault(self._fn_name(fn), SourceStats()) for fn in fns}
+        backups = sorted([fn for fn in fns if not stats[fn].backed_off] or fns,
+                         key=lambda fn: stats[fn].score, reverse=True)
+
+        quorum = min(settings.BLOCKHEIGHT_QUORUM, len(backups))
+        hedge_delay = settings.BLOCKHEIGHT_HEDGE_DELAY
+        start = time.monotonic()
+
+        pending = {}
+        launched = {}  # task -> monotonic time it was launched at; latency is per source
+        heights = {}
+
+        def launch(n: int):
+            for fn in backups[:max(n, 0)]:
+                task = asyncio.ensure_future(fn())
+                pending[task] = fn
+                launched[task] = time.monotonic()
+            del backups[:max(n, 0)]
+
+        height = None
+        launch(quorum if hedge_delay > 0 else len(backups))
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay or None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(1)
                     continue
 
-            if heights:
-                data[coin_network_type] = popularity_contest(heights)
+                for task in done:
+                    fn = pending.pop(task)
+                    try:
+                        heights[fn] = task.result()
+                        stats[fn].success(time.monotonic() - launched[task])
+                    except Exception as ex:
+                        stats[fn].failure(time.monotonic() - launched[task], self.interval)
+                        app.logger.error(f"blockheight fetch failed from {self._fn_name(fn)}: {ex}")
 
-        if data["mainnet"] == 0:  # only care about mainnet
-            app.logger.error(f"Failed to parse latest blockheight!")
+                height, votes = Counter(heights.values()).most_common(1)[0] if heights else (None, 0)
+                if votes >= quorum:
+                    app.logger.info(f"blockheight {height} in {time.monotonic() - start:.2f}s, "
+                                    f"{votes}/{len(heights)} agreeing")
+                    break
+
+                # not enough outstanding sources left to reach the quorum
+                launch(quorum - votes - len(pending))
+            else:
+                height = self._weighted_vote(heights, stats)
+                app.logger.warning(f"blockheight quorum of {quorum} not reached, {height} "
+                                   f"from {len(heights)}/{len(fns)} sources in {time.monotonic() - start:.2f}s")
+        finally:
+            for task, fn in pending.items():
+                task.cancel()
+                stats[fn].cancelled(time.monotonic() - launched[task])
+
+        for fn, _height in heights.items():
+            stats[fn].voted(_height == height)
+        return height
+
+    @staticmethod
+    def _weighted_vote(heights: dict, stats: Dict[object, SourceStats]) -> Union[int, None]:
+        """The height with the highest total agreement of its voters, highest on ties."""
+        if not heights:
             return
+        weights = Counter()
+        for fn, height in heights.items():
+            weights[height] += stats[fn].agreement
+        return max(weights, key=lambda height: (weights[height], height))
 
-        return data
+    def _daemon_fresh(self) -> bool:
+        return self._daemon_height is not None and \
+            time.monotonic() - self._daemon_seen < self._daemon_max_age
+
+    async def _on_daemon_height(self, height: int) -> None:
+        """Publish a height reported by the local daemon right away."""
+        self._daemon_height, self._daemon_seen = height, time.monotonic()
+
+        data = await self.cache_get(self._cache_key) or {t: 0 for t in ["mainnet", "stagenet", "testnet"]}
+        if height <= data.get(settings.COIN_MODE, 0):
+            return
+        data[settings.COIN_MODE] = height
+        await self.publish(data)
+
+    async def _daemon_supervisor(self) -> None:
+        """Runs `_daemon()`, restarted with a backoff when it fails."""
+        from wowlet_backend.factory import app
+        backoff = 1
+        while True:
+            started = time.monotonic()
+            try:
+                return await self._daemon()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if time.monotonic() - started > 300:
+                    backoff = 1
+                app.logger.error(f"blockheight: daemon listener failed, restarting in {backoff}s: {ex}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 300)
+
+    async def _daemon(self) -> None:
+        from wowlet_backend.factory import app
+        if settings.BLOCKHEIGHT_ZMQ:
+            if zmq:
+                return await self._daemon_zmq()
+            app.logger.error("BLOCKHEIGHT_ZMQ is set, but pyzmq is not installed")
+        if settings.BLOCKHEIGHT_RPC:
+            await self._daemon_rpc()
+
+    async def _daemon_zmq(self) -> None:
+        """Subscribe to the `json-minimal-chain_main` notifications
+        of `monerod --zmq-pub`; ZMQ reconnects by itself."""
+        from wowlet_backend.factory import app
+        topic = "json-minimal-chain_main"
+        socket = zmq.asyncio.Context.instance().socket(zmq.SUB)
+        socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        socket.connect(settings.BLOCKHEIGHT_ZMQ)
+        app.logger.info(f"blockheight: listening on {settings.BLOCKHEIGHT_ZMQ}")
+
+        try:
+            while True:
+                msg = await socket.recv_string()
+                try:
+                    blob = json.loads(msg[len(topic) + 1:])
+                    height = int(blob["first_height"]) + len(blob["ids"]) - 1
+                except (ValueError, KeyError, TypeError) as ex:
+                    app.logger.error(f"blockheight: bad ZMQ message: {ex}")
+                    continue
+                await self._on_daemon_height(height)
+        finally:
+            socket.close()
+
+    async def _daemon_rpc(self) -> None:
+        """Poll the daemon's `/get_height`; a cheap call on a local daemon."""
+        from wowlet_backend.factory import app
+        url = settings.BLOCKHEIGHT_RPC.rstrip("/") + "/get_height"
+        failing = False
+
+        while True:
+            try:
+                blob = await httpget(url, json=True)
+                # the amount of blocks, the explorers report the height of the top block
+                await self._on_daemon_height(int(blob["height"]) - 1)
+                failing = False
+            except Exception as ex:
+                if not failing:
+                    app.logger.error(f"blockheight: daemon RPC {url} failed: {ex}")
+                failing = True
+            await asyncio.sleep(self._daemon_poll_interval)
+
+    @staticmethod
+    def _fn_name(fn) -> str:
+        if isinstance(fn, partial):
+            return fn.keywords.get("url", fn.func.__name__)
+        return fn.__name__
 
     async def _blockchair(self) -> int:
         re_blockheight = r"<a href=\".*\">(\d+)</a>"
@@ -9,6 +9,7 @@ from dateutil.parser import parse
 import settings
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class ForumThreadsTask(WowletTask):
@@ -23,7 +24,7 @@ class ForumThreadsTask(WowletTask):
         # url
         self._http_endpoint = "https://forum.wownero.com/latest.json"
 
-        self._websocket_cmd = "forum"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
     async def task(self):
         from wowlet_backend.factory import app
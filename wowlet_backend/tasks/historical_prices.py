@@ -4,111 +4,329 @@
 
 import asyncio
 import os
+import csv
 import json
-from typing import List, Union
-from datetime import datetime
+import math
+from typing import Dict, Iterator, List, Tuple, Union
+from datetime import date, datetime, timedelta, timezone
 
 import aiofiles
 
 import settings
 from wowlet_backend.utils import httpget
+from wowlet_backend.encoders import RawJSON
+from wowlet_backend.pricestore import PriceStore
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.tasks.rates_fiat import FIAT_CURRENCIES, ECB_ENDPOINT
+
+
+# currencies `HistoricalPriceTask.get()` can answer in
+CURRENCIES = ["EUR"] + FIAT_CURRENCIES
 
 
 class HistoricalPriceTask(WowletTask):
     """
-    This class manages a historical price (USD) database, saved in a
-    textfile at `self._path`. A Feather wallet instance will ask
-    for the historical fiat price database on startup (but only
-    in chunks of a month for anti-fingerprinting reasons).
+    This class manages a historical price (USD) database, saved as
+    a compact array of daily prices at `self._path` (see `PriceStore`),
+    and the historical ECB exchange rates next to it, from which
+    the prices in every other fiat currency are derived.
+    A Feather wallet instance will ask for the historical fiat price
+    database on startup (but only in chunks of a month for
+    anti-fingerprinting reasons).
 
-    The task in this class simply keeps the fiat database
-    up-to-date locally.
+    The task in this class keeps the fiat database up-to-date
+    locally by fetching only the days it is missing, and precomputes
+    the responses. The full history is downloaded on a fresh
+    install, on request, or when the local database looks off.
     """
     def __init__(self, interval: int = 43200):
         super(HistoricalPriceTask, self).__init__(interval)
 
-        self._cache_key = f"historical_fiat"
-        self._path = f"data/historical_prices_{settings.COIN_SYMBOL}.json"
+        self._path = f"data/historical_prices_{settings.COIN_SYMBOL}.bin"
+        self._path_legacy = f"data/historical_prices_{settings.COIN_SYMBOL}.json"
         self._http_endpoint = f"https://www.coingecko.com/price_charts/{settings.COIN_NAME}/usd/max.json"
+        self._http_endpoint_range = f"https://api.coingecko.com/api/v3/coins/{settings.COIN_NAME}/market_chart/range?vs_currency=usd&from={{start}}&to={{end}}"
+
+        # `redis-cli set historical_fiat_resync 1` forces a full re-sync on the next run
+        self._resync_key = "historical_fiat_resync"
+
+        # max. relative difference for a price we already have, before we distrust the local database
+        self._integrity_tolerance = 0.02
+
+        self._genesis = datetime.strptime(settings.COIN_GENESIS_DATE, "%Y%m%d").date()
+        self._store = PriceStore(self._path)
+
+        # EUR:currency, as published by the ECB (business days only)
+        self._fiat_endpoint = ECB_ENDPOINT + "?format=csvdata&startPeriod={start}"
+        self._fiat = {currency: PriceStore(f"data/historical_rates_EUR{currency}.bin")
+                      for currency in FIAT_CURRENCIES}
 
-        self._year_genesis = int(settings.COIN_GENESIS_DATE[:4])
+        # a rate is carried forward over at most this many days (weekends, holidays);
+        # currencies quoted longer ago than that are no longer published
+        self._fiat_max_gap = timedelta(days=7)
 
         asyncio.create_task(self._load())
 
     async def task(self) -> Union[dict, None]:
+        from wowlet_backend.factory import app, cache
+
+        try:
+            await self._sync_fiat()
+        except Exception as ex:
+            # prices in other currencies are derived from the last known rates
+            app.logger.error(f"{self._qualname} - fiat rates: {ex}")
+
+        if len(self._store) and not await cache.exists(self._resync_key):
+            if await self._sync_incremental():
+                await self._precompute()
+                return self._summary()
+            app.logger.warning(f"{self._qualname} - integrity check failed, full re-sync")
+
+        await self._sync_full()
+        await cache.delete(self._resync_key)
+        await self._precompute()
+        return self._summary()
+
+    async def _sync_full(self) -> None:
+        """Download the complete history and replace the local database."""
         content = await httpget(self._http_endpoint, json=True, raise_for_status=False)
         if "stats" not in content:
             raise Exception()
 
         stats: List[List] = content.get('stats', [])  # [[timestamp,USD],]
         if not stats:
-            return
+            raise Exception("empty price history")
 
-        data = {
-            year: {
-                month: {} for month in range(1, 13)
-            } for year in range(self._year_genesis, datetime.now().year + 1)
-        }
+        await self._write(self._normalize(stats))
 
-        # timestamp:USD
-        daily_price_blob = {day[0]: day[1] for day in stats}
+    async def _sync_incremental(self) -> bool:
+        """Fetch the days since the last stored day (which may have been
+        incomplete), and append them. The day before serves as an integrity
+        check, or is filled in when missing; returns False on a mismatch."""
+        last_day = self._store.last_day
+        overlap = last_day - timedelta(days=1)
+        start = datetime.combine(overlap, datetime.min.time(), tzinfo=timezone.utc)
 
-        # normalize
-        for timestamp, usd in daily_price_blob.items():
-            _date = datetime.fromtimestamp(timestamp / 1000)
-            data[_date.year].setdefault(_date.month, {})
-            data[_date.year][_date.month][_date.day] = usd
+        url = self._http_endpoint_range.format(start=int(start.timestamp()),
+                                               end=int(datetime.now(timezone.utc).timestamp()))
+        content = await httpget(url, json=True)
+        prices = self._normalize(content.get("prices", []))
+        if not prices:
+            raise Exception("empty price range")
 
-        # update local database
-        await self._write(data)
-        return data
+        start = max(self._store.index(overlap), 0)
+        stored = self._store.price(overlap)
+        fetched = prices.get(start)
+        if stored and fetched and abs(fetched - stored) > stored * self._integrity_tolerance:
+            return False
+        if stored:
+            prices[start] = stored
+
+        # days missing from the response keep the price we have
+        known = self._store.range(overlap, last_day).tolist()
+        data = [prices.get(i, known[i - start] if i - start < len(known) else math.nan)
+                for i in range(start, max(prices) + 1)]
+        if data:
+            await self._store.extend(start, data)
+        return True
+
+    async def _sync_fiat(self) -> None:
+        """Fetch the ECB rates since a week before the oldest last stored
+        day of the currencies still published (rates may get revised), or
+        all of them for a fresh install."""
+        stores = self._fiat.values()
+        if all(len(store) for store in stores):
+            newest = max(store.last_day for store in stores)
+            start = min(store.last_day for store in stores
+                        if newest - store.last_day <= self._fiat_max_gap) - timedelta(days=7)
+        else:
+            start = self._genesis
+
+        content = await httpget(self._fiat_endpoint.format(start=start.isoformat()), json=False, timeout=30)
+
+        rates: Dict[str, Dict[int, float]] = {}
+        for row in csv.DictReader(content.splitlines()):
+            if row.get("CURRENCY") not in self._fiat or not row.get("OBS_VALUE"):
+                continue
+            _date = datetime.strptime(row["TIME_PERIOD"], "%Y-%m-%d").date()
+            rates.setdefault(row["CURRENCY"], {})[(_date - self._genesis).days] = float(row["OBS_VALUE"])
+
+        for currency, values in rates.items():
+            store = self._fiat[currency]
+            values = {k: v for k, v in values.items() if k >= 0}
+            if not values:
+                continue
+            if len(store) and store.genesis == self._genesis and start > self._genesis:
+                offset = min(store.index(start), len(store))
+                data = [values.get(i, math.nan) for i in range(offset, max(values) + 1)]
+                await store.extend(offset, data)
+            else:
+                data = [values.get(i, math.nan) for i in range(max(values) + 1)]
+                await PriceStore.write(store.path, self._genesis, data)
+                store.open()
+
+    def _normalize(self, stats: List[List]) -> Dict[int, float]:
+        """[[timestamp,USD],] -> days since genesis:USD. The first data point
+        of a (UTC) day is used, so that daily and hourly data agree."""
+        prices = {}
+        for timestamp, usd in sorted(stats):
+            _date = datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).date()
+            prices.setdefault((_date - self._genesis).days, usd)
+        return prices
+
+    def _summary(self) -> dict:
+        return {
+            "days": len(self._store),
+            "last_day": self._store.last_day.isoformat()
+        }
 
     async def _load(self) -> None:
-        if not os.path.exists(self._path):
+        from wowlet_backend.factory import app
+        for store in self._fiat.values():
+            try:
+                store.open()
+            except ValueError as ex:
+                # refetched on the next run of `task()`
+                app.logger.error(f"{self._qualname} - {ex}")
+
+        try:
+            if not self._store.open():
+                await self._migrate()
+        except ValueError as ex:
+            # refreshed on the next run of `task()`
+            app.logger.error(f"{self._qualname} - {ex}")
+            return
+
+        if len(self._store):
+            await self._precompute()
+
+    async def _migrate(self) -> None:
+        """Convert the legacy year/month/day JSON database."""
+        if not os.path.exists(self._path_legacy):
+            return
+
+        async with aiofiles.open(self._path_legacy, mode="r") as f:
+            blob = json.loads(await f.read())
+
+        prices = {}
+        for year, months in blob.items():
+            for month, days in months.items():
+                for day, usd in days.items():
+                    _date = datetime(int(year), int(month), int(day)).date()
+                    prices[(_date - self._genesis).days] = usd
+        await self._write(prices)
+
+    async def _write(self, prices: Dict[int, float]) -> None:
+        """Replace the local database; `prices` as days since genesis:USD"""
+        prices = {k: v for k, v in prices.items() if k >= 0}
+        if not prices:
+            return
+
+        data = [math.nan] * (max(prices) + 1)
+        for i, usd in prices.items():
+            data[i] = usd
+
+        await PriceStore.write(self._path, self._genesis, data)
+        self._store.open()
+
+    def _prices(self, currency: str) -> Iterator[Tuple[date, float]]:
+        """(day, price) in `currency`; the EUR rates are forward-filled over
+        weekends and holidays (up to `_fiat_max_gap`), as the ECB would
+        quote the previous rate."""
+        if currency == "USD":
+            yield from self._store.items()
             return
 
-        async with aiofiles.open(self._path, mode="r") as f:
-            content = await f.read()
-            blob = json.loads(content)
+        usd, rate = self._fiat["USD"], self._fiat.get(currency)  # no rate for EUR
+        usd_rate, currency_rate = (math.nan, None), (1.0, None) if rate is None else (math.nan, None)
+        day = self._store.genesis
+        for _date, price in self._store.items():
+            # walk every day, also those without a coin price
+            while day <= _date:
+                if usd.price(day):
+                    usd_rate = usd.price(day), day
+                if rate is not None and rate.price(day):
+                    currency_rate = rate.price(day), day
+                day += timedelta(days=1)
 
-            # ¯\_(ツ)_/¯
-            blob = {int(k): {
-                int(_k): {
-                    int(__k): __v for __k, __v in _v.items()
-                } for _k, _v in v.items()
-            } for k, v in blob.items()}
+            if any(math.isnan(value) or (quoted and _date - quoted > self._fiat_max_gap)
+                   for value, quoted in [usd_rate, currency_rate]):
+                continue
+            yield _date, price / usd_rate[0] * currency_rate[0]
 
-            await self.cache_set(self._cache_key, blob)
+    async def _precompute(self) -> None:
+        """Encode the response to every `get(year)` and `get(year, month)`,
+        in every currency once, so that serving a request is a single
+        Redis GET."""
+        from wowlet_backend.factory import cache
+
+        pipe = cache.pipeline()
+        for currency in CURRENCIES:
+            months = {}
+            for _date, price in self._prices(currency):
+                months.setdefault((_date.year, _date.month), {})[f"{_date:%Y%m%d}"] = price
 
-    async def _write(self, blob: dict) -> None:
-        data = json.dumps(blob, sort_keys=True, indent=4)
-        async with aiofiles.open(self._path, mode="w") as f:
-            await f.write(data)
+            years = {}
+            for (year, month), rtn in months.items():
+                rtn = json.dumps(rtn)
+                pipe.set(self._key(year, month, currency), rtn)
+                years.setdefault(year, []).append(rtn[1:-1])
+            for year, rtn in years.items():
+                # splice the months together
+                pipe.set(self._key(year, currency=currency), "{" + ", ".join(rtn) + "}")
+        await pipe.execute()
 
     @staticmethod
-    async def get(year: int, month: int = None) -> Union[dict, None]:
+    def _key(year: int, month: int = None, currency: str = "USD") -> str:
+        if not month:
+            return f"historical_fiat_{currency}_{year}"
+        return f"historical_fiat_{currency}_{year}_{month}"
+
+    @staticmethod
+    async def get(year: int, month: int = None, currency: str = "USD") -> Union[RawJSON, None]:
         """This function is called when a Feather wallet client asks
         for (a range of) historical fiat information. It returns the
-        data filtered by the parameters."""
+        data filtered by the parameters, as precomputed by `_precompute()`."""
         from wowlet_backend.factory import cache
 
-        blob = await cache.get("historical_fiat")
-        blob = json.loads(blob)
-        if year not in blob:
+        rtn = await cache.get(HistoricalPriceTask._key(year, month, currency))
+        if not rtn:
             return
+        return RawJSON(rtn)
 
-        rtn = {}
-        if not month:
-            for _m, days in blob[year].items():
-                for day, price in days.items():
-                    rtn[datetime(year, _m, day).strftime('%Y%m%d')] = price
-            return rtn
+    @staticmethod
+    async def get_months(months: List[Tuple[int, int]], currency: str = "USD") -> RawJSON:
+        """Several months in one response, as one flat `{"YYYYMMDD": USD}`
+        object; a single MGET, the precomputed months are spliced together."""
+        from wowlet_backend.factory import cache
+        if not months:
+            return RawJSON(b"{}")
 
-        if month not in blob[year]:
-            return
+        keys = [HistoricalPriceTask._key(year, month, currency) for year, month in sorted(set(months))]
+        rtn = await cache.mget(*keys)
+        return RawJSON(b"{" + b", ".join(v[1:-1] for v in rtn if v and len(v) > 2) + b"}")
 
-        for day, price in blob[year][month].items():
-            rtn[datetime(year, month, day).strftime('%Y%m%d')] = price
+    @staticmethod
+    async def get_range(start: date, end: date, granularity: str = "month", currency: str = "USD") -> RawJSON:
+        """`start` up to and including `end`. With "month" granularity whole
+        months are returned (anti-fingerprinting), with "day" the first and
+        last month are trimmed; only those two are decoded."""
+        months = HistoricalPriceTask.months_between(start, end)
+        if granularity != "day":
+            return await HistoricalPriceTask.get_months(months, currency)
+
+        from wowlet_backend.factory import cache
+        rtn = await cache.mget(*[HistoricalPriceTask._key(year, month, currency) for year, month in months])
 
-        return rtn
+        lower, upper = f"{start:%Y%m%d}", f"{end:%Y%m%d}"
+        for i in {0, len(rtn) - 1}:
+            if rtn[i]:
+                days = {k: v for k, v in json.loads(rtn[i]).items() if lower <= k <= upper}
+                rtn[i] = json.dumps(days).encode()
+        return RawJSON(b"{" + b", ".join(v[1:-1] for v in rtn if v and len(v) > 2) + b"}")
+
+    @staticmethod
+    def months_between(start: date, end: date) -> List[Tuple[int, int]]:
+        """(year, month) for every month that overlaps `start` - `end`."""
+        return [(i // 12, i % 12 + 1) for i in range(start.year * 12 + start.month - 1,
+                                                     end.year * 12 + end.month)]
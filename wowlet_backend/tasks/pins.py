@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2020, The Monero Project.
+# Copyright (c) 2020, dsc@xmr.pm
+
+from wowlet_backend.utils import redis_eval
+from wowlet_backend.tasks import WowletTask
+
+
+class PinPoolTask(WowletTask):
+    """
+    Returns expired PINs to the free pool used by
+    `WebsocketParse.requestPIN`, so that allocation stays
+    O(1) near saturation. Also reports the occupancy of the
+    (4-digit) PIN space.
+    """
+    def __init__(self, interval: int = 30):
+        super(PinPoolTask, self).__init__(interval)
+
+        self._cache_key = "pin_pool_stats"
+        self._cache_expiry = self.interval * 10
+
+        self._occupancy_warning = 0.9
+
+    async def task(self) -> dict:
+        from wowlet_backend.factory import app
+        from wowlet_backend.wsparse import LUA_SWEEP_PINS, pin_script_args, pin_stats
+
+        reclaimed = await redis_eval(LUA_SWEEP_PINS, **pin_script_args())
+        stats = await pin_stats()
+        stats["reclaimed"] = reclaimed
+
+        if stats["occupancy"] > self._occupancy_warning:
+            app.logger.warning(f"PIN space is {stats['occupancy'] * 100:.1f}% occupied")
+        return stats
@@ -8,6 +8,7 @@ from typing import List
 import settings
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class FundingProposalsTask(WowletTask):
@@ -34,18 +35,11 @@ class FundingProposalsTask(WowletTask):
             self._http_endpoint = self._http_endpoint[:-1]
 
         # websocket
-        self._websocket_cmd = "funding_proposals"
-        self._websocket_cmds = {
-            "xmr": "ccs",
-            "wow": "wfs"
-        }
-
-        if settings.COIN_SYMBOL not in self._websocket_cmds:
+        self._websocket_cmd = websocket_cmd(self._cache_key)
+        if not self._websocket_cmd:
             app.logger.warning(f"Missing websocket cmd for {settings.COIN_SYMBOL.upper()}, ignoring update task")
             self._active = False
 
-        self._websocket_cmd = self._websocket_cmds[settings.COIN_SYMBOL]
-
     async def task(self):
         if settings.COIN_SYMBOL == "xmr":
             return await self._xmr()
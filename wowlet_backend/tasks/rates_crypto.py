@@ -8,6 +8,7 @@ from typing import List, Union
 import settings
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 from wowlet_backend.factory import cache
 
 
@@ -18,7 +19,7 @@ class CryptoRatesTask(WowletTask):
         self._cache_key = "crypto_rates"
         self._cache_expiry = self.interval * 10
 
-        self._websocket_cmd = "crypto_rates"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
         self._http_api_gecko = "https://api.coingecko.com/api/v3"
 
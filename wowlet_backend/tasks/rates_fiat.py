@@ -7,6 +7,13 @@ import re
 
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
+
+# ECB reference rates, base currency EUR; also used for the historical prices
+FIAT_CURRENCIES = ["USD", "GBP", "JPY", "CZK", "CAD", "ZAR", "KRW", "MXN", "RUB", "SEK",
+                   "THB", "NZD", "AUD", "CHF", "TRY", "CNY"]
+
+ECB_ENDPOINT = f"https://sdw-wsrest.ecb.europa.eu/service/data/EXR/D.{'+'.join(FIAT_CURRENCIES)}.EUR.SP00.A"
 
 
 class FiatRatesTask(WowletTask):
@@ -16,9 +23,9 @@ class FiatRatesTask(WowletTask):
         self._cache_key = "fiat_rates"
         self._cache_expiry = self.interval * 10
 
-        self._websocket_cmd = "fiat_rates"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
-        self._http_endpoint = "https://sdw-wsrest.ecb.europa.eu/service/data/EXR/D.USD+GBP+JPY+CZK+CAD+ZAR+KRW+MXN+RUB+SEK+THB+NZD+AUD+CHF+TRY+CNY.EUR.SP00.A"
+        self._http_endpoint = ECB_ENDPOINT
 
     async def task(self):
         """Fetch fiat rates"""
@@ -6,6 +6,7 @@ import html
 import settings
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class RedditTask(WowletTask):
@@ -16,7 +17,7 @@ class RedditTask(WowletTask):
         self._cache_key = "reddit"
         self._cache_expiry = self.interval * 10
 
-        self._websocket_cmd = "reddit"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
         self._http_endpoints = {
             "xmr": "https://www.reddit.com/r/monero",
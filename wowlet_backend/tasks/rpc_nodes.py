@@ -2,12 +2,14 @@
 # Copyright (c) 2020, The Monero Project.
 # Copyright (c) 2020, dsc@xmr.pm
 
-import json
-from typing import List
+import time
+import asyncio
+from typing import Dict, List
 
 import settings
 from wowlet_backend.utils import httpget, popularity_contest
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class RPCNodeCheckTask(WowletTask):
@@ -17,73 +19,146 @@ class RPCNodeCheckTask(WowletTask):
         self._cache_key = "rpc_nodes"
         self._cache_expiry = None
 
-        self._websocket_cmd = "nodes"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
         self._http_timeout = 5
         self._http_timeout_onion = 10
 
-    async def task(self) -> List[dict]:
-        """Check RPC nodes status"""
-        from wowlet_backend.factory import app, cache
+        # concurrent checks per network type; created on first use
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
 
-        try:
-            heights = json.loads(await cache.get("blockheights"))
-        except:
-            heights = {}
+        # publish results of a run that is still going at most this often (secs)
+        self._publish_interval = 5
+
+        # the scheme each node answered on last time, tried first. Plain HTTP
+        # nodes are probed for HTTPS again every `_reprobe_runs` runs.
+        self._schemes: Dict[str, str] = {}
+        self._reprobe_runs = 30
+        self._runs = 0
+
+    async def task(self) -> List[dict]:
+        """Check RPC nodes status, concurrently; nodes that are not
+        checked by `RPC_NODES_DEADLINE` are reported as offline. While
+        the run is going, the results so far are published."""
+        self._runs += 1
+        if not self._semaphores:
+            self._semaphores = {
+                "clearnet": asyncio.Semaphore(settings.RPC_NODES_CONCURRENCY),
+                "tor": asyncio.Semaphore(settings.RPC_NODES_CONCURRENCY_TOR)
+            }
 
         rpc_nodes = await self.cache_json_get("nodes")
         if not rpc_nodes:
             rpc_nodes = {}
 
+        previous = await self.cache_get(self._cache_key)
+        previous = {self._node_key(node): node for node in previous or []}
+
+        jobs = {}
+        for network_type_coin, _ in rpc_nodes.items():
+            for network_type, _nodes in _.items():
+                for node in _nodes:
+                    jobs[(network_type_coin, node)] = asyncio.ensure_future(
+                        self._check(node, network_type_coin, network_type))
+
+        deadline = time.monotonic() + settings.RPC_NODES_DEADLINE
+        pending = set(jobs.values())
+        try:
+            while pending:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                _, pending = await asyncio.wait(pending, timeout=min(timeout, self._publish_interval))
+                if pending and time.monotonic() < deadline:
+                    await self.publish(self._collect(rpc_nodes, jobs, previous))
+        finally:
+            for job in pending:
+                job.cancel()
+
+        return self._collect(rpc_nodes, jobs, previous, final=True)
+
+    async def _check(self, node: str, network_type_coin: str, network_type: str) -> dict:
+        from wowlet_backend.factory import app
+        async with self._semaphores["tor" if network_type == "tor" else "clearnet"]:
+            for scheme in self._scheme_order(node):
+                try:
+                    blob = await self.node_check(f"{scheme}://{node}", network_type=network_type)
+                    blob['tls'] = True if scheme == "https" else False
+                    self._schemes[node] = scheme
+                    return blob
+                except asyncio.CancelledError:
+                    # an `Exception` on Python 3.7; do not swallow the cancel at the deadline
+                    raise
+                except Exception as ex:
+                    continue
+
+        app.logger.warning(f"node {node} not reachable")
+        return self._bad_node({
+            "address": node,
+            "nettype": network_type_coin,
+            "type": network_type,
+            "height": 0,
+            "tls": False
+        }, reason="unreachable")
+
+    def _scheme_order(self, node: str) -> List[str]:
+        # spread the re-probes over the runs
+        if self._schemes.get(node) == "http" and (self._runs + hash(node)) % self._reprobe_runs:
+            return ["http", "https"]
+        return ["https", "http"]
+
+    def _collect(self, rpc_nodes: dict, jobs: dict, previous: dict, final: bool = False) -> List[dict]:
+        """The nodes that were checked; nodes that were not (yet) are taken
+        from the previous run, or reported offline: as pending when they
+        have no previous result, as timed out when `final`. Every node
+        is listed, so the list does not change size between publishes."""
         nodes = []
         for network_type_coin, _ in rpc_nodes.items():
             data = []
 
             for network_type, _nodes in _.items():
                 for node in _nodes:
-                    for scheme in ["https", "http"]:
-                        try:
-                            blob = await self.node_check(f"{scheme}://{node}", network_type=network_type)
-                            blob['tls'] = True if scheme == "https" else False
-                            data.append(blob)
-                            break
-                        except Exception as ex:
-                            continue
-
-                    if not data:
-                        app.logger.warning(f"node {node} not reachable")
+                    job = jobs[(network_type_coin, node)]
+                    if job.done() and not job.cancelled():
+                        data.append(job.result())
+                    elif not final and (network_type_coin, node) in previous:
+                        data.append(previous[(network_type_coin, node)])
+                    else:
                         data.append(self._bad_node({
                             "address": node,
                             "nettype": network_type_coin,
                             "type": network_type,
-                            "height": 0,
-                            "tls": False
-                        }, reason="unreachable"))
+                            "height": 0
+                        }, reason="timeout" if final else "pending"))
 
-            # not necessary for stagenet/testnet nodes to be validated
-            if network_type_coin != "mainnet":
-                nodes += data
-                continue
+            nodes += self._validate(network_type_coin, data)
+        return nodes
 
-            if not data:
-                continue
+    def _validate(self, network_type_coin: str, data: List[dict]) -> List[dict]:
+        # not necessary for stagenet/testnet nodes to be validated
+        if network_type_coin != "mainnet":
+            return data
 
-            # Filter out nodes affected by < v0.17.1.3 sybil attack
-#            data = list(map(lambda _node: _node if _node['target_height'] <= _node['height']
-#                            else self._bad_node(_node, reason="+2_attack"), data))
+        # Filter out nodes affected by < v0.17.1.3 sybil attack
+#        data = list(map(lambda _node: _node if _node['target_height'] <= _node['height']
+#                        else self._bad_node(_node, reason="+2_attack"), data))
 
-            allowed_offset = 3
-            valid_heights = []
-            # current_blockheight = heights.get(network_type_coin, 0)
+        allowed_offset = 3
 
-            # popularity contest
-            common_height = popularity_contest([z['height'] for z in data if z['height'] != 0])
-            valid_heights = range(common_height + allowed_offset, common_height - allowed_offset, -1)
+        # popularity contest
+        common_height = popularity_contest([z['height'] for z in data if z['height'] != 0])
+        if common_height is None:
+            return data
+        valid_heights = range(common_height + allowed_offset, common_height - allowed_offset, -1)
 
-            data = list(map(lambda _node: _node if _node['height'] in valid_heights
-                            else self._bad_node(_node, reason="out_of_sync"), data))
-            nodes += data
-        return nodes
+        return list(map(lambda _node: _node if _node['height'] in valid_heights or not _node['online']
+                        else self._bad_node(_node, reason="out_of_sync"), data))
+
+    @staticmethod
+    def _node_key(node: dict) -> tuple:
+        """(nettype, host:port) of a result, as in `data/nodes.json`"""
+        return node['nettype'], node['address'].split("://")[-1]
 
     async def node_check(self, node, network_type: str) -> dict:
         """Call /get_info on the RPC, return JSON"""
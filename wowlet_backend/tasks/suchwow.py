@@ -15,6 +15,7 @@ from bs4 import BeautifulSoup
 import settings
 from wowlet_backend.utils import httpget, image_resize
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class SuchWowTask(WowletTask):
@@ -31,7 +32,7 @@ class SuchWowTask(WowletTask):
         self._http_endpoint = "https://suchwow.xyz/"
         self._tmp_dir = os.path.join(settings.cwd, "data", "suchwow")
 
-        self._websocket_cmd = "suchwow"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
         if not os.path.exists(self._tmp_dir):
             os.mkdir(self._tmp_dir)
@@ -7,6 +7,7 @@ from dateutil.parser import parse
 import settings
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class WowletReleasesTask(WowletTask):
@@ -17,7 +18,7 @@ class WowletReleasesTask(WowletTask):
         self._cache_key = "wowlet_releases"
         self._cache_expiry = self.interval
 
-        self._websocket_cmd = "wowlet_releases"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
         self._http_endpoint = "https://git.wownero.com/api/v1/repos/wowlet/wowlet/releases?limit=1"
 
@@ -7,6 +7,7 @@ from dateutil.parser import parse
 import settings
 from wowlet_backend.utils import httpget
 from wowlet_backend.tasks import WowletTask
+from wowlet_backend.snapshot import websocket_cmd
 
 
 class XmrigTask(WowletTask):
@@ -17,7 +18,7 @@ class XmrigTask(WowletTask):
         self._cache_key = "xmrig"
         self._cache_expiry = self.interval * 10
 
-        self._websocket_cmd = "xmrig"
+        self._websocket_cmd = websocket_cmd(self._cache_key)
 
         self._http_endpoint = "https://api.github.com/repos/xmrig/xmrig/releases"
 
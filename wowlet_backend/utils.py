@@ -3,11 +3,9 @@
 # Copyright (c) 2020, dsc@xmr.pm
 
 import re
-import json
-import asyncio
 import os
 import random
-from datetime import datetime
+import hashlib
 from collections import Counter
 from functools import wraps
 from typing import List, Union
@@ -15,6 +13,7 @@ from io import BytesIO
 
 import psutil
 import aiohttp
+import aioredis
 from aiohttp_socks import ProxyConnector
 from PIL import Image
 
@@ -44,13 +43,14 @@ def print_banner():
 def collect_websocket(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        from wowlet_backend.factory import connected_websockets
-        queue = asyncio.Queue()
-        connected_websockets.add(queue)
+        from wowlet_backend.fanout import ClientQueue, register, unregister
+        queue = ClientQueue(maxsize=settings.WS_QUEUE_SIZE,
+                            max_lag=settings.WS_QUEUE_MAX_LAG)
+        register(queue)
         try:
             return await func(queue, *args, **kwargs)
         finally:
-            connected_websockets.remove(queue)
+            unregister(queue)
     return wrapper
 
 
@@ -71,32 +71,51 @@ async def httpget(url: str, json=True, timeout: int = 5, socks5: str = None, rai
             return result
 
 
+async def redis_eval(script: str, keys: List[str] = None, args: list = None):
+    """Run a Lua script on Redis; by SHA1 once it is loaded."""
+    from wowlet_backend.factory import cache
+    sha = hashlib.sha1(script.encode()).hexdigest()
+    try:
+        return await cache.evalsha(sha, keys=keys or [], args=args or [])
+    except aioredis.ReplyError as ex:
+        if not str(ex).startswith("NOSCRIPT"):
+            raise
+        return await cache.eval(script, keys=keys or [], args=args or [])
+
+
 def random_agent():
     from wowlet_backend.factory import user_agents
     return random.choice(user_agents)
 
 
-async def feather_data():
-    """A collection of data collected by
-    `FeatherTask`, for Feather wallet clients."""
-    from wowlet_backend.factory import cache, now
-    data = await cache.get("data")
-    if data:
-        data = json.loads(data)
-        return data
-
-    keys = ["blockheights", "funding_proposals", "crypto_rates", "fiat_rates", "reddit", "rpc_nodes", "xmrig", "xmrto_rates", "suchwow", "forum", "wowlet_releases"]
-    data = {keys[i]: json.loads(val) if val else None for i, val in enumerate(await cache.mget(*keys))}
-
-    # @TODO: for backward-compat reasons we're including some legacy keys which can be removed after 1.0 release
-    data['nodes'] = data['rpc_nodes']
-    data['ccs'] = data['funding_proposals']
-    data['wfs'] = data['funding_proposals']
-
-    # start caching when application lifetime is more than 20 seconds
-    if (datetime.now() - now).total_seconds() > 20:
-        await cache.setex("data", 30, json.dumps(data))
-    return data
+def accept_encoding(header: str, available: List[str]) -> str:
+    """Pick the first of `available` content-encodings that the
+    `Accept-Encoding` header allows, otherwise `identity`."""
+    accepted = {}
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+
+    for coding in available:
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return "identity"
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """`If-None-Match` uses the weak comparison function."""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return any(tag[2:] == etag if tag.startswith("W/") else tag == etag for tag in tags)
 
 
 def popularity_contest(lst: List[int]) -> Union[int, None]:
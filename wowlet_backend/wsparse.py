@@ -2,36 +2,236 @@
 # Copyright (c) 2020, The Monero Project.
 # Copyright (c) 2020, dsc@xmr.pm
 
-import random
-import time
-import json
-from datetime import datetime, timedelta
-from typing import Dict, Union, Optional
-from copy import deepcopy
 import asyncio
+from datetime import datetime, timezone
 import re
 
-from wowlet_backend.utils import RE_ADDRESS
+from wowlet_backend.utils import RE_ADDRESS, redis_eval
 
 
-PIN_SPACE_AMOUNT = list(range(1, 10000))
-PIN_CODES = {str(k): None for k in PIN_SPACE_AMOUNT}
+# max. amount of months in a single `txFiatHistory` request
+FIAT_HISTORY_MAX_MONTHS = 240
+
+PIN_SPACE = range(1, 10000)
+PIN_TTL = 600
+
+# Free PINs live in the `pin_pool` set, allocated PINs in the `pin_expiry`
+# sorted set (scored by expiry), which `PinPoolTask` sweeps back into the pool.
+PIN_KEY_POOL = "pin_pool"
+PIN_KEY_EXPIRY = "pin_expiry"
+PIN_KEY_READY = "pin_pool_ready"
+
+# all scripts use the clock of Redis, the one `pin_code_<n>` keys expire on;
+# TIME needs effects replication before Redis 5. The guards keep the scripts
+# working on fakeredis (Lua 5.4 via lupa), see `utils/bench_pins.py --fake`.
+_LUA_NOW = """
+local unpack = unpack or table.unpack
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+"""
+
+# seeds the pool once (or after a FLUSHDB), skipping PINs that are in use
+# KEYS: pin_pool, pin_expiry, pin_pool_ready
+# ARGV: first PIN, last PIN
+_LUA_SEED_PINS = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    for n = tonumber(ARGV[1]), tonumber(ARGV[2]) do
+        local ttl = redis.call('PTTL', 'pin_code_' .. n)
+        if ttl > 0 then
+            redis.call('ZADD', KEYS[2], now + ttl / 1000, n)
+        else
+            redis.call('SADD', KEYS[1], n)
+        end
+    end
+    redis.call('SET', KEYS[3], 1)
+end
+"""
+
+# KEYS: pin_pool, pin_expiry, pin_pool_ready, pin_<address>
+# ARGV: first PIN, last PIN, address, ttl
+LUA_REQUEST_PIN = _LUA_NOW + """
+local existing = redis.call('GET', KEYS[4])
+if existing then
+    return existing
+end
+""" + _LUA_SEED_PINS + """
+while true do
+    local number = redis.call('SPOP', KEYS[1])
+    if not number then
+        -- pool drained, reclaim expired PINs ahead of the sweeper
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)
+        if #expired == 0 then
+            return false
+        end
+        redis.call('ZREM', KEYS[2], unpack(expired))
+        redis.call('SADD', KEYS[1], unpack(expired))
+        number = redis.call('SPOP', KEYS[1])
+    end
+
+    if redis.call('SET', 'pin_code_' .. number, ARGV[3], 'EX', ARGV[4], 'NX') then
+        redis.call('SET', KEYS[4], number, 'EX', ARGV[4])
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), number)
+        return number
+    end
+
+    -- still in use; track it by its actual expiry and try another
+    local ttl = redis.call('PTTL', 'pin_code_' .. number)
+    redis.call('ZADD', KEYS[2], now + (ttl > 0 and ttl / 1000 or tonumber(ARGV[4])), number)
+end
+"""
+
+# KEYS: pin_pool, pin_expiry, pin_pool_ready
+# ARGV: first PIN, last PIN
+LUA_SWEEP_PINS = _LUA_NOW + _LUA_SEED_PINS + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for i = 1, #expired, 1000 do
+    local chunk = {unpack(expired, i, math.min(i + 999, #expired))}
+    redis.call('ZREM', KEYS[2], unpack(chunk))
+    redis.call('SADD', KEYS[1], unpack(chunk))
+end
+return #expired
+"""
+
+
+def pin_key(number: int) -> str:
+    return f"pin_code_{number}"
+
+
+def pin_script_args(*args) -> dict:
+    return {
+        "keys": [PIN_KEY_POOL, PIN_KEY_EXPIRY, PIN_KEY_READY],
+        "args": [PIN_SPACE[0], PIN_SPACE[-1], *args]
+    }
+
+
+async def pin_stats() -> dict:
+    """Occupancy of the PIN space; by the allocated PINs, as
+    the free pool is empty until it is first seeded."""
+    from wowlet_backend.factory import cache
+    free, allocated = await asyncio.gather(cache.scard(PIN_KEY_POOL), cache.zcard(PIN_KEY_EXPIRY))
+    return {
+        "size": len(PIN_SPACE),
+        "free": free,
+        "allocated": allocated,
+        "occupancy": round(allocated / len(PIN_SPACE), 4)
+    }
 
 
 class WebsocketParse:
     @staticmethod
-    async def parser(cmd: str, data=None):
-        if cmd == "txFiatHistory":
+    async def parser(cmd: str, data=None, client=None):
+        """
+        :param client: the `ClientQueue` of the connection
+        """
+        if cmd == "hello":
+            return await WebsocketParse.hello(data, client)
+        elif cmd == "subscribe":
+            return await WebsocketParse.subscribe(data, client)
+        elif cmd == "unsubscribe":
+            return await WebsocketParse.unsubscribe(data, client)
+        elif cmd == "txFiatHistory":
             return await WebsocketParse.txFiatHistory(data)
         elif cmd == "requestPIN":
             return await WebsocketParse.requestPIN(data)
         elif cmd == "lookupPIN":
             return await WebsocketParse.lookupPIN(data)
+        elif cmd == "restoreHeight":
+            return await WebsocketParse.restoreHeight(data)
+
+    @staticmethod
+    async def hello(data=None, client=None) -> dict:
+        """Protocol negotiation, returns the accepted options.
+
+        delta: receive `{"cmd", "seq", "patch"}` JSON-patch frames against
+               the previous `seq` when possible. A full `{"cmd", "seq", "data"}`
+               frame is sent whenever the client may be out of sync.
+        batch: pending updates may arrive as one `{"cmd": "batch", "data": [frame, ...]}`
+               frame.
+        encoding: one of `wowlet_backend.encoders.ENCODERS`, e.g. "msgpack"; applies to
+                  all frames after the reply to this command."""
+        if not data or not isinstance(data, dict) or client is None:
+            return {}
+
+        rtn = {}
+        if data.get("delta") is True:
+            client.enable_delta()
+            rtn["delta"] = True
+        if data.get("batch") is True:
+            client.batch = True
+            rtn["batch"] = True
+        if isinstance(data.get("encoding"), str):
+            from wowlet_backend import encoders
+            encoder = encoders.get(data["encoding"])
+            if encoder:
+                client.encoder = encoder
+                rtn["encoding"] = encoder.name
+        return rtn
+
+    @staticmethod
+    async def subscribe(data=None, client=None) -> dict:
+        """Only receive updates for the given list of commands. Clients
+        that never (un)subscribe receive all of them."""
+        if not data or not isinstance(data, list) or client is None:
+            return {}
+        if not all(isinstance(topic, str) for topic in data):
+            return {}
+
+        from wowlet_backend.fanout import subscribe
+        return {"topics": sorted(subscribe(client, data))}
+
+    @staticmethod
+    async def unsubscribe(data=None, client=None) -> dict:
+        if not data or not isinstance(data, list) or client is None:
+            return {}
+        if not all(isinstance(topic, str) for topic in data):
+            return {}
+
+        from wowlet_backend.fanout import unsubscribe
+        return {"topics": sorted(unsubscribe(client, data))}
 
     @staticmethod
     async def txFiatHistory(data=None):
+        """{"year": int, "month": int} for a single year or month, or a batch:
+
+        {"months": [[year, month], ...]}
+        {"from": "YYYYMMDD", "to": "YYYYMMDD", "granularity": "month"|"day"}
+
+        The default "month" granularity returns whole months, so that the
+        exact dates a wallet is interested in are not revealed. Prices are
+        in USD, unless another `"currency"` is given."""
         if not data or not isinstance(data, dict):
             return
+
+        from wowlet_backend.tasks.historical_prices import HistoricalPriceTask, CURRENCIES
+        currency = data.get('currency', 'USD')
+        if currency not in CURRENCIES:
+            return
+
+        if "months" in data:
+            months = data['months']
+            if not isinstance(months, list) or len(months) > FIAT_HISTORY_MAX_MONTHS:
+                return
+            if not all(isinstance(m, list) and len(m) == 2 and
+                       all(isinstance(i, int) for i in m) and 1 <= m[1] <= 12 for m in months):
+                return
+            return await HistoricalPriceTask.get_months([tuple(m) for m in months], currency)
+
+        if "from" in data or "to" in data:
+            granularity = data.get('granularity', 'month')
+            if granularity not in ["month", "day"]:
+                return
+            try:
+                start = datetime.strptime(data['from'], "%Y%m%d").date()
+                end = datetime.strptime(data['to'], "%Y%m%d").date()
+            except (KeyError, TypeError, ValueError):
+                return
+            if start > end or len(HistoricalPriceTask.months_between(start, end)) > FIAT_HISTORY_MAX_MONTHS:
+                return
+            return await HistoricalPriceTask.get_range(start, end, granularity, currency)
+
         if "year" not in data or not isinstance(data['year'], int):
             return
         if "month" in data and not isinstance(data['month'], int):
@@ -39,13 +239,10 @@ class WebsocketParse:
 
         year = data.get('year')
         month = data.get('month')
-
-        from wowlet_backend.tasks.historical_prices import HistoricalPriceTask
-        return await HistoricalPriceTask.get(year, month)
+        return await HistoricalPriceTask.get(year, month, currency)
 
     @staticmethod
     async def requestPIN(data=None) -> str:
-        from wowlet_backend.factory import cache
         if not data or not isinstance(data, dict):
             return ""
         if "address" not in data or not isinstance(data['address'], str):
@@ -57,45 +254,14 @@ class WebsocketParse:
         if not re.match(RE_ADDRESS, address) or not signature.startswith("Sig"):
             return ""
 
-        cache_key_address = f"pin_{address}"
-        cache_key_lookups = "pin_space"
-        ttl = 600
-
-        lock = asyncio.Lock()
-        async with lock:
-            result = await cache.get(cache_key_address)
-            if result:
-                return result.decode().zfill(4)
-
-            lookups = await cache.get(cache_key_lookups)
-            if not lookups:
-                await cache.set(cache_key_lookups, json.dumps(PIN_CODES).encode())
-                lookups: Dict[str, Optional[dict]] = PIN_CODES
-            else:
-                lookups: Dict[str, Optional[dict]] = json.loads(lookups)
-
-            space = deepcopy(PIN_SPACE_AMOUNT)
-            random.shuffle(space)
-            now = int(time.time())
-
-            for number in space:
-                _blob = lookups[str(number)]
-                if _blob:
-                    until = _blob.get('until')
-                    if now > until:
-                        _blob = None  # expired, mark as writeable
-
-                if not _blob:
-                    valid_until = int(time.time()) + ttl
-                    lookups[str(number)] = {
-                        "address": address,
-                        "until": valid_until
-                    }
-
-                    await cache.setex(cache_key_address, ttl, number)
-                    await cache.set(cache_key_lookups, json.dumps(lookups).encode())
-                    return str(number).zfill(4)
+        # atomic; concurrent requests (also from other workers) can not
+        # claim the same PIN, nor claim two PINs for one address.
+        opts = pin_script_args(address, PIN_TTL)
+        opts["keys"].append(f"pin_{address}")
+        result = await redis_eval(LUA_REQUEST_PIN, **opts)
+        if not result:
             return ""
+        return result.decode().zfill(4)
 
     @staticmethod
     async def lookupPIN(data=None) -> dict:
@@ -108,26 +274,49 @@ class WebsocketParse:
         if not re.match("^\d{4}$", PIN):
             return {}
 
-        cache_key_lookups = "pin_space"
-        lookups = await cache.get(cache_key_lookups)
-        if not lookups:
-            await cache.set(cache_key_lookups, json.dumps(PIN_CODES).encode())
-            lookups: Dict[str, Optional[dict]] = PIN_CODES
-        else:
-            lookups: Dict[str, Optional[dict]] = json.loads(lookups)
-
-        blob = lookups.get(str(int(PIN)))
-        if not blob:
-            return {"address": "", "PIN": PIN}  # undefined behavior
-
-        address = blob.get('address')
-        until = blob.get('until')
-
-        now = int(time.time())
-        if now > until:
-            return {"address": "", "PIN": PIN}  # entry expired
+        address = await cache.get(pin_key(int(PIN)))
+        if not address:
+            return {"address": "", "PIN": PIN}  # unused or expired
 
         return {
-            "address": address,
+            "address": address.decode(),
             "PIN": PIN
         }
+
+    @staticmethod
+    async def restoreHeight(data=None) -> dict:
+        """{"date": "YYYYMMDD"} or {"timestamp": int} -> {"height": int}, the
+        height to restore a wallet created at that time from; {"height": int}
+        -> {"timestamp": int, "date": "YYYYMMDD"}, approximately."""
+        if not data or not isinstance(data, dict):
+            return {}
+
+        from wowlet_backend.restoreheights import current
+        index = await current()
+        if index is None:
+            return {}
+
+        if isinstance(data.get('height'), int):
+            timestamp = index.timestamp_at(data['height'])
+            if timestamp is None:
+                return {}
+            return {
+                "height": data['height'],
+                "timestamp": timestamp,
+                "date": datetime.utcfromtimestamp(timestamp).strftime("%Y%m%d")
+            }
+
+        if isinstance(data.get('timestamp'), int):
+            timestamp = data['timestamp']
+        elif isinstance(data.get('date'), str):
+            try:
+                timestamp = int(datetime.strptime(data['date'], "%Y%m%d").replace(tzinfo=timezone.utc).timestamp())
+            except ValueError:
+                return {}
+        else:
+            return {}
+
+        height = index.height_at(timestamp)
+        if height is None:
+            return {}
+        return {"height": height}